@@ -1,15 +1,166 @@
 # vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
 import json
 import os
-from fabric.api import env, sudo, local, execute, settings
+import sys
+import fabric.api
+from fabric.api import env, execute, settings
 from fabric.context_managers import hide
 from time import sleep
 from fabric.colors import green, yellow, red
 
-from boto.ec2.blockdevicemapping import BlockDeviceMapping
-from boto.ec2.blockdevicemapping import EBSBlockDeviceType
-
 import socket
+import threading
+
+# per-host cache of facts gathered by host_facts(), keyed by env.host_string
+_HOST_FACTS = {}
+
+# per-host index of installed packages built by package_inventory(),
+# keyed by env.host_string
+_PACKAGE_INVENTORY = {}
+
+# shared cloud connections handed out by connect_to_ec2() and
+# connect_to_rackspace(), keyed by cloud, region and credentials
+_CLOUD_CONNECTIONS = {}
+_CLOUD_CONNECTIONS_LOCK = threading.Lock()
+
+# caps on the number of concurrent API calls per cloud, see cloud_call()
+_CLOUD_API_SEMAPHORES = {}
+
+# timings of every wait_for() call made in this session, see wait_timings()
+_WAIT_TIMINGS = []
+
+# every remote command, local command, cloud API call and wait recorded in
+# this session, see trace_summary() and export_trace()
+_TRACE = []
+
+# serialises updates of the package cache indexes between threads, see
+# _update_package_cache_index()
+_PACKAGE_CACHE_LOCK = threading.Lock()
+
+# per-host index of docker images and containers built by
+# docker_inventory(), keyed by env.host_string
+_DOCKER_INVENTORY = {}
+
+# hosts we have opened a multiplexed ssh master connection to, see
+# ssh_command()
+_SSH_MASTERS = set()
+
+# the batch() currently recording commands, per thread
+_BATCH = threading.local()
+
+# cloud backends by name, see register_cloud_backend()
+_CLOUD_BACKENDS = {}
+
+# the most values ec2 accepts in a single describe filter
+EC2_FILTER_VALUES_LIMIT = 200
+
+# the actions a cloud backend can provide
+CLOUD_ACTIONS = ['up', 'halt', 'destroy', 'status', 'create_image',
+                 'create_fleet', 'find_image']
+
+# in memory copy of the state store, see load_state_store(). re-read from
+# disk only when the file changes.
+_STATE_CACHE = {}
+_STATE_LOCK = threading.Lock()
+
+# query formats used to build the package inventory, one package per line:
+# name, version and architecture separated by tabs
+RPM_QUERY_FORMAT = '%{NAME}\\t%{VERSION}-%{RELEASE}\\t%{ARCH}\\n'
+DPKG_QUERY_FORMAT = ('${Package}\\t${Version}\\t${Architecture}'
+                     '\\t${Status}\\n')
+
+# prefix of the lines systemd() reads the exit status of each systemctl
+# call from
+SYSTEMD_STATUS_MARKER = '__systemctl_status__'
+
+# formats used to build the docker inventory, one image/container per line
+DOCKER_IMAGES_FORMAT = '{{.Repository}}\\t{{.Tag}}\\t{{.ID}}\\t{{.Digest}}'
+DOCKER_PS_FORMAT = '{{.ID}}\\t{{.Names}}\\t{{.Image}}\\t{{.Status}}'
+
+
+class _TracedClient(object):
+    """ proxies a cloud client, recording every API call in the trace
+
+        methods of the client and of its direct attributes (ie: the
+        nova.servers manager) are traced, objects they return are not.
+    """
+
+    def __init__(self, client, cloud, prefix=''):
+        self._client = client
+        self._cloud = cloud
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        label = self._prefix + name
+        if callable(attr):
+            def _traced_call(*args, **kwargs):
+                from time import time
+
+                started = time()
+                try:
+                    return attr(*args, **kwargs)
+                finally:
+                    _record_trace('api', sys._getframe(1).f_code.co_name,
+                                  label, started, host=self._cloud)
+            return _traced_call
+        if not self._prefix and hasattr(attr, '__dict__'):
+            return _TracedClient(attr, self._cloud, label + '.')
+        return attr
+
+
+class BatchedCommand(object):
+    """ the result of a _sudo/_run call recorded inside a batch()
+
+        stdout, return_code, succeeded and failed are filled in once the
+        batch has run. return_code stays None for steps which didn't run
+        because an earlier step failed.
+    """
+
+    def __init__(self, kind, command, warn_only, user=None):
+        self.kind = kind
+        self.command = command
+        self.warn_only = warn_only
+        self.user = user
+        self.stdout = ''
+        self.return_code = None
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    @property
+    def failed(self):
+        return not self.succeeded
+
+    def __str__(self):
+        return self.stdout
+
+
+class CloudFuture(object):
+    """ the pending result of an API call started with cloud_call() """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """ waits for the call to finish and returns its result, re-raising
+            any exception it raised
+        """
+        self._done.wait(timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _finish(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done.set()
 
 
 def add_epel_yum_repository():
@@ -17,32 +168,85 @@ def add_epel_yum_repository():
     yum_install(packages=["epel-release"])
 
 
-def add_firewalld_service(service, permanent=True):
-    """ adds a firewall rule """
+def add_firewalld_rules(services=None, ports=None, zones=None,
+                        permanent=True):
+    """ adds a set of firewall rules, skipping the ones already in place
+
+        p services: services to allow in the default zone
+        p ports: ports to allow in the default zone, ie: 80/tcp or 8080
+        p zones: a dict of {zone: {'services': [...], 'ports': [...]}}
+        p permanent: make the rules permanent, and reload them into the
+                     runtime configuration
+
+        the current configuration of every zone is read with a single
+        firewall-cmd call, and only the missing rules are applied, followed
+        by one reload, in a second call.
+        returns a dict of {zone: {'services': [added], 'ports': [added]}}
+    """
     yum_install(packages=['firewalld'])
-    from fabric.api import settings
-    from fabric.context_managers import hide
+    p = ''
+    if permanent:
+        p = '--permanent '
 
     with settings(hide('warnings', 'running', 'stdout', 'stderr'),
                   warn_only=True, capture=True):
-        p = ''
+        result = _sudo('firewall-cmd --get-default-zone && '
+                      'firewall-cmd %s--list-all-zones' % p)
+    if result.return_code != 0:
+        log_red('failed to read the firewalld configuration')
+        print(result)
+        raise SystemExit()
+    default_zone, current = _parse_firewalld_zones(result)
+
+    desired = {}
+    for zone, rules in (zones or {}).items():
+        desired[zone] = {'services': list(rules.get('services', [])),
+                         'ports': list(rules.get('ports', []))}
+    if services or ports:
+        rules = desired.setdefault(default_zone, {'services': [],
+                                                  'ports': []})
+        rules['services'] += list(services or [])
+        rules['ports'] += list(ports or [])
+
+    added = {}
+    commands = []
+    for zone, rules in sorted(desired.items()):
+        live = current.get(zone, {'services': [], 'ports': []})
+        missing_services = [svc for svc in rules['services']
+                            if svc not in live['services']]
+        missing_ports = [port for port in
+                         [str(port) if '/' in str(port) else '%s/tcp' % port
+                          for port in rules['ports']]
+                         if port not in live['ports']]
+        added[zone] = {'services': missing_services, 'ports': missing_ports}
+        if missing_services or missing_ports:
+            commands.append('firewall-cmd %s--zone=%s %s' % (
+                p, zone,
+                ' '.join(['--add-service=%s' % svc
+                          for svc in missing_services] +
+                         ['--add-port=%s' % port for port in missing_ports])))
+
+    if commands:
         if permanent:
-            p = '--permanent'
-        sudo('firewall-cmd --add-service %s %s' % (service, p))
+            # permanent rules only reach the runtime configuration on reload
+            commands.append('firewall-cmd --reload')
+        with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                      warn_only=True, capture=True):
+            result = _sudo(' && '.join(commands))
+            if result.return_code != 0:
+                log_red(result)
 
+    return added
 
-def add_firewalld_port(port, permanent=True):
+
+def add_firewalld_service(service, permanent=True):
     """ adds a firewall rule """
-    yum_install(packages=['firewalld'])
-    from fabric.api import settings
-    from fabric.context_managers import hide
+    return add_firewalld_rules(services=[service], permanent=permanent)
 
-    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
-                  warn_only=True, capture=True):
-        p = ''
-        if permanent:
-            p = '--permanent'
-        sudo('firewall-cmd --add-port %s %s' % (port, p))
+
+def add_firewalld_port(port, permanent=True):
+    """ adds a firewall rule """
+    return add_firewalld_rules(ports=[port], permanent=permanent)
 
 
 def add_zfs_yum_repository():
@@ -56,102 +260,484 @@ def add_zfs_yum_repository():
 
 
 def arch():
-    """ returns the current cpu archictecture """
-    from fabric.api import settings
-    from fabric.context_managers import hide
+    """ returns the rpm dist tag of the current host (ie: .el7) """
+    return host_facts()['dist']
 
-    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
-                  warn_only=True, capture=True):
-        result = sudo('rpm -E %dist').strip()
+
+def _batched_command(kind, command, args, kwargs):
+    """ records a command in the current batch(), applying the cd(),
+        prefix(), path() and shell_env() contexts active at the time of the
+        call the way fabric would
+
+        the warn_only and quiet keywords are honoured, and so is user for
+        sudo. any other argument would change how fabric runs the command,
+        which a batch can't do, so it stops the run.
+    """
+    kwargs = dict(kwargs)
+    warn_only = kwargs.pop('warn_only', env.get('warn_only', False))
+    warn_only = kwargs.pop('quiet', False) or warn_only
+    user = kwargs.pop('user', None) if kind == 'sudo' else None
+    # the defaults are harmless, every step already runs in a shell
+    for name in ['shell', 'pty']:
+        if kwargs.get(name, True) is True:
+            kwargs.pop(name, None)
+    if args or kwargs:
+        log_red("%s() can't take %s inside batch(): %s" % (
+            kind, ', '.join(sorted(kwargs) or ['positional arguments']),
+            command))
+        raise SystemExit()
+
+    # as fabric's _prefix_commands() and _prefix_env_vars(). cd() already
+    # escapes the spaces in env.cwd, and leaves a leading ~ to the shell
+    prefixes = list(env.get('command_prefixes', []))
+    if env.get('cwd'):
+        prefixes.insert(0, 'cd %s >/dev/null' % env.cwd)
+    env_vars = {}
+    if env.get('path'):
+        env_vars['PATH'] = {
+            'append': '$PATH:"%s"',
+            'prepend': '"%s":$PATH',
+            'replace': '"%s"',
+        }[env.get('path_behavior', 'append')] % env.path
+    for name, value in env.get('shell_env', {}).items():
+        for char in ['"', '$', '`']:
+            value = value.replace(char, '\\' + char)
+        env_vars[name] = '"%s"' % value
+    if env_vars:
+        prefixes.insert(0, 'export ' + ' '.join(
+            '%s=%s' % item for item in sorted(env_vars.items())))
+    step = BatchedCommand(kind, ' && '.join(prefixes + [command]),
+                          warn_only, user=user)
+    _BATCH.steps.append(step)
+    return step
+
+
+def batch():
+    """ records the _sudo/_run calls made inside the block instead of
+        running them, then runs them all as a single remote script
+
+        with batch():
+            _sudo('echo foo >> /etc/foo')
+            result = _sudo('yum install -y foo')
+        print(result.return_code)
+
+        calls return a BatchedCommand, filled in when the block exits. the
+        script stops at the first failing step unless warn_only was set
+        for it, as fabric would. only batch helpers which don't look at the
+        output of their commands before the block exits.
+    """
+    from contextlib import contextmanager
+
+    @contextmanager
+    def _batch():
+        if getattr(_BATCH, 'steps', None) is not None:
+            # nested batches are part of the outer one
+            yield _BATCH.steps
+            return
+        _BATCH.steps = []
+        try:
+            yield _BATCH.steps
+            steps = _BATCH.steps
+        finally:
+            _BATCH.steps = None
+        _run_batch(steps)
+
+    return _batch()
+
+
+def _cached_package_install(key, download, install, ttl=None):
+    """ installs packages through the local package cache
+
+        the first host needing a set of packages only downloads them, the
+        files are copied back into env.package_cache_dir and installed from
+        there. the hosts after it get the cached files pushed over their
+        ssh connection instead of fetching them from the mirrors again.
+
+        p key: identifies the set of packages in the cache
+        p download: command downloading the packages into {dir}
+        p install: command installing the packages, from the files listed
+                   in {files} or from the directory {dir}
+        p ttl: seconds after which the packages are downloaded again
+
+        returns the result of the install command, or None when nothing
+        could be downloaded
+    """
+    import tarfile
+    import tempfile
+    import time
+    import uuid
+
+    cache_dir = _package_cache_dir()
+    remote_dir = '/tmp/package-cache-%s' % uuid.uuid4().hex
+    entry = _package_cache_index(cache_dir).get(key)
+    if entry and (ttl and time.time() - entry['time'] > ttl or
+                  not all(os.path.isfile(os.path.join(cache_dir, f))
+                          for f in entry['files'])):
+        entry = None
+
+    fd, archive = tempfile.mkstemp(suffix='.tar')
+    os.close(fd)
+    try:
+        with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                      warn_only=True, capture=True):
+            if entry:
+                files = entry['files']
+                log_green('pushing %d cached packages...' % len(files))
+                with tarfile.open(archive, 'w') as tar:
+                    for name in files:
+                        tar.add(os.path.join(cache_dir, name), arcname=name)
+                fabric.api.put(archive, remote_dir + '.tar')
+                _sudo('mkdir -p {0} && tar xf {0}.tar -C {0}'.format(
+                    remote_dir))
+            else:
+                log_green('downloading packages into the package cache...')
+                result = _sudo(
+                    "mkdir -p {dir}/partial && ({download}) >/dev/null 2>&1; "
+                    "cd {dir} && ls | grep -E '\\.(rpm|deb)$' | "
+                    "tee {dir}.list && tar cf {dir}.tar -T {dir}.list".format(
+                        dir=remote_dir,
+                        download=download.format(dir=remote_dir)))
+                files = [line.strip() for line in result.splitlines()
+                         if line.strip()]
+                if files:
+                    fabric.api.get(remote_dir + '.tar', archive)
+                    with tarfile.open(archive) as tar:
+                        tar.extractall(cache_dir)
+                    _update_package_cache_index(cache_dir, key, files)
+
+            result = None
+            if files:
+                result = _sudo(install.format(
+                    dir=remote_dir,
+                    files=' '.join('%s/%s' % (remote_dir, name)
+                                   for name in files)))
+            _sudo('rm -rf {0} {0}.tar {0}.list'.format(remote_dir))
+    finally:
+        os.remove(archive)
     return result
 
 
 def cache_docker_image_locally(docker_image):
     # download docker images to speed up provisioning
-    sudo("docker -q pull %s" % docker_image)
+    return cache_docker_images_locally([docker_image])[docker_image]
 
 
-def connect_to_ec2():
-    """ returns a connection object to AWS EC2  """
-    import boto.ec2
-    conn = boto.ec2.connect_to_region(env.ec2_region,
-                                      aws_access_key_id=env.ec2_key,
-                                      aws_secret_access_key=env.ec2_secret)
-    return conn
+def cache_docker_images_locally(images, concurrency=None):
+    """ pulls a list of docker images concurrently, in a single remote call
 
+        images already present on the host, by repo:tag or by digest, are
+        skipped.
+        p concurrency: number of parallel pulls, defaults to
+                       env.docker_pull_concurrency or 4
 
-def connect_to_rackspace():
-    """ returns a connection object to Rackspace  """
-    import pyrax
+        returns a dict of {image: True|False}, True if the image is present
+        on the host after the pulls
+    """
+    if concurrency is None:
+        concurrency = env.get('docker_pull_concurrency', 4)
 
-    pyrax.set_setting('identity_type', env.os_auth_system)
-    pyrax.set_default_region(env.os_region_name)
-    pyrax.set_credentials(env.os_username, env.os_password)
-    nova = pyrax.connect_to_cloudservers(region=env.os_region_name)
-    return nova
+    missing = [image for image in images if not does_image_exist(image)]
+    if missing:
+        log_green('pulling %s ...' % ' '.join(missing))
+        with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                      warn_only=True, capture=True):
+            _sudo("printf '%%s\\n' %s | xargs -n 1 -P %d docker pull -q" % (
+                ' '.join(missing), int(concurrency)))
+        update_docker_inventory(missing)
+        for image in missing:
+            if not does_image_exist(image):
+                log_red('failed to pull %s' % image)
 
+    return dict((image, does_image_exist(image)) for image in images)
 
-def create_ami(instance_id, name, description, block_device_mapping=None):
-    conn = connect_to_ec2()
-    ami = conn.create_image(instance_id,
-                            name,
-                            description,
-                            block_device_mapping)
-
-    image_status = conn.get_image(ami)
-    while (image_status.state != "available" and
-           image_status.state != "failed"):
-        log_yellow('creating ami...')
-        sleep_for_one_minute()
-        image_status = conn.get_image(ami)
-
-    if image_status.state == "available":
-        log_green("ami %s %s" % (ami, image_status))
-        return(ami)
-    else:
-        log_red("ami %s %s" % (ami, image_status))
-        return False
 
+def _parse_firewalld_zones(output):
+    """ parses the output of 'firewall-cmd --get-default-zone &&
+        firewall-cmd --list-all-zones'
 
-def create_image(instance_id, name, description, block_device_mapping=None):
-    """ proxy call for ec2, rackspace create ami backend functions """
-    if env.cloud == 'ec2':
-        return(create_ami(instance_id,
-                          name,
-                          description,
-                          block_device_mapping=None))
+        returns (default zone, {zone: {'services': [...], 'ports': [...]}})
+    """
+    lines = [line.rstrip() for line in output.splitlines() if line.strip()]
+    default_zone = lines[0].strip() if lines else 'public'
+
+    zones = {}
+    zone = None
+    for line in lines[1:]:
+        if not line[0].isspace():
+            # 'public (active)'
+            zone = line.split()[0]
+            zones[zone] = {'services': [], 'ports': []}
+        elif zone is not None and ':' in line:
+            key, _, values = line.strip().partition(':')
+            if key in ['services', 'ports']:
+                zones[zone][key] = values.split()
+    return default_zone, zones
+
+
+def _pooled_connection(key, connect):
+    """ returns a shared connection from the pool, creating it if needed
+
+        p key: a tuple identifying the cloud, region and credentials
+        p connect: callable returning a tuple of (connection, expires), where
+                   expires is the epoch time the connection (or its auth
+                   token) stops being valid, or None if it doesn't expire
+    """
+    from time import time
+
+    with _CLOUD_CONNECTIONS_LOCK:
+        entry = _CLOUD_CONNECTIONS.get(key)
+        # renew a bit before the token expires, so that a call started
+        # just before expiry doesn't fail half way through
+        if (entry is None or
+                (entry['expires'] is not None and
+                 entry['expires'] - 300 < time())):
+            conn, expires = connect()
+            entry = {'conn': _TracedClient(conn, key[0]), 'expires': expires}
+            _CLOUD_CONNECTIONS[key] = entry
+        return entry['conn']
+
+
+def _cloud_action(action):
+    """ returns the function implementing action for env.cloud
+
+        backends registered as a module path are imported here, the first
+        time one of their actions is needed.
+    """
+    backend = _CLOUD_BACKENDS.get(env.get('cloud'))
+    if backend is None:
+        log_red("unknown cloud '%s'" % env.get('cloud'))
+        raise SystemExit()
+
+    if not isinstance(backend, dict):
+        import importlib
+        module = importlib.import_module(backend)
+        backend = dict((name, getattr(module, name))
+                       for name in CLOUD_ACTIONS if hasattr(module, name))
+        _CLOUD_BACKENDS[env.cloud] = backend
+
+    if action not in backend:
+        log_red("cloud '%s' doesn't support %s" % (env.cloud, action))
+        raise SystemExit()
+    return backend[action]
+
+
+def _cloud_module(name):
+    """ imports and returns one of the cloud backend modules shipped next to
+        this one, e.g. cloud_ec2
+    """
+    import importlib
+    return importlib.import_module(_sibling_module(name))
 
-    if env.cloud == 'rackspace':
-        return(create_rackspace_image(instance_id,
-                                      name,
-                                      description,
-                                      block_device_mapping=None))
+
+def cloud_call(cloud, func, *args, **kwargs):
+    """ starts an API call in the background and returns a CloudFuture
+
+        p cloud: the cloud the call goes to, 'ec2' or 'rackspace'. at most
+                 env.cloud_api_concurrency[cloud] calls (default 10 for
+                 ec2, 5 for anything else) run at once per cloud.
+
+        throttled calls (RequestLimitExceeded, Throttling, OverLimit) are
+        retried with exponential backoff, up to env.cloud_api_retries
+        (default 5) times.
+    """
+    import random
+
+    future = CloudFuture()
+    semaphore = _cloud_api_semaphore(cloud)
+    retries = env.get('cloud_api_retries', 5)
+
+    def _call():
+        delay = 1
+        for attempt in range(retries + 1):
+            with semaphore:
+                try:
+                    future._finish(result=func(*args, **kwargs))
+                    return
+                except Exception as e:
+                    if not _is_throttled(e) or attempt == retries:
+                        future._finish(error=e)
+                        return
+            sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, 30)
+
+    thread = threading.Thread(target=_call)
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+def _cloud_api_semaphore(cloud):
+    """ returns the semaphore capping concurrent API calls to a cloud """
+    with _CLOUD_CONNECTIONS_LOCK:
+        if cloud not in _CLOUD_API_SEMAPHORES:
+            limits = env.get('cloud_api_concurrency', {})
+            _CLOUD_API_SEMAPHORES[cloud] = threading.BoundedSemaphore(
+                limits.get(cloud, 10 if cloud == 'ec2' else 5))
+        return _CLOUD_API_SEMAPHORES[cloud]
+
+
+def claim_pool_member(role=None):
+    """ hands a ready instance from the warm pool over to the current
+        instance name, see fill_pool()
+
+        p role: defaults to env.instance_role
+
+        returns the state of the instance, or None if the pool is empty
+    """
+    role = role or env.get('instance_role', None)
+    fingerprint = None
+    if env.get('provisioning_recipe'):
+        fingerprint = provisioning_fingerprint()
+    name = current_instance_name()
+
+    def _claim(store):
+        if name in store['instances']:
+            return None
+        ready = sorted(member for member, data in store['instances'].items()
+                       if data.get('pool') == 'ready' and
+                       data.get('role') == role and
+                       (fingerprint is None or
+                        data.get('fingerprint') == fingerprint))
+        if not ready:
+            return None
+        data = store['instances'].pop(ready[0])
+        del data['pool']
+        data['name'] = name
+        store['instances'][name] = data
+        return data
+
+    data = update_state_store(_claim)
+    if data is None:
+        log_yellow('no warm instance available for role %s' % role)
+        return None
+
+    if env.get('data_json', True):
+        _write_json_atomically('data.json', data)
+    log_green('took %s from the warm pool' % data['id'])
+    return data
+
+
+def close_ssh_masters():
+    """ closes the multiplexed ssh master connections opened by
+        ssh_command() in this session
+    """
+    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                  warn_only=True):
+        for host in list(_SSH_MASTERS):
+            _local('%s -O exit %s@%s' % (ssh_command(host), env.user, host),
+                  capture=True)
+            _SSH_MASTERS.discard(host)
+
+
+def connect_to_ec2(region=None):
+    """ returns a connection object to AWS EC2
+        p region: defaults to env.ec2_region
+    """
+    region = region or env.ec2_region
+
+    def _connect():
+        import boto.ec2
+        conn = boto.ec2.connect_to_region(region,
+                                          aws_access_key_id=env.ec2_key,
+                                          aws_secret_access_key=env.ec2_secret)
+        return conn, None
+
+    return _pooled_connection(
+        ('ec2', region, env.ec2_key, env.ec2_secret), _connect)
+
+
+def connect_to_rackspace():
+    """ returns a connection object to Rackspace  """
+    def _connect():
+        import pyrax
+        from calendar import timegm
+
+        # use a private identity context rather than pyrax's global one, so
+        # that connections for different credentials can live side by side
+        context = pyrax.create_context(id_type=env.os_auth_system,
+                                       username=env.os_username,
+                                       password=env.os_password)
+        context.authenticate()
+        nova = context.get_client('compute', env.os_region_name)
+
+        # pyrax keeps the token expiry in expires, and raises for unknown
+        # attributes once authenticated. without one the client isn't
+        # reused, expires 0 has already passed.
+        expires = getattr(context, 'expires', None)
+        if expires:
+            return nova, timegm(expires.utctimetuple())
+        return nova, 0
+
+    return _pooled_connection(
+        ('rackspace', env.os_region_name, env.os_auth_system,
+         env.os_username, env.os_password), _connect)
+
+
+def create_ami(instance_id, name, description, block_device_mapping=None,
+               regions=None, fingerprint=None):
+    """ creates an ami from an instance and waits until it is available
+
+        p block_device_mapping: a boto BlockDeviceMapping for the image
+        p regions: optional list of regions to copy the ami to, the copies
+                   are started together and waited on together
+        p fingerprint: the provisioning fingerprint to tag the ami (and its
+                       copies) with, see provisioning_fingerprint()
+
+        returns the ami id, or False if it failed. when regions are given,
+        returns a dict of {region: ami id or False} which includes the
+        source region.
+    """
+    return _cloud_module('cloud_ec2').create_image(
+        instance_id, name, description,
+        block_device_mapping=block_device_mapping,
+        regions=regions,
+        fingerprint=fingerprint)
+
+
+def create_image(instance_id, name, description, block_device_mapping=None,
+                 **kwargs):
+    """ proxy call for the create image function of the cloud backend,
+        extra keyword arguments (ie: regions for ec2) are passed through
+    """
+    return(_cloud_action('create_image')(
+        instance_id,
+        name,
+        description,
+        block_device_mapping=block_device_mapping,
+        **kwargs))
 
 
 def create_rackspace_image(server_id,
                            name,
                            description,
-                           block_device_mapping=None):
-    import sys
-    if not is_there_state():
-        log_red("can't find a valid state file")
-        sys.exit(1)
+                           block_device_mapping=None,
+                           fingerprint=None):
+    """ creates an image from the current rackspace server
 
-    nova = connect_to_rackspace()
-    data = load_state_from_disk()
+        p fingerprint: the provisioning fingerprint to store in the image
+                       metadata, see provisioning_fingerprint()
+    """
+    return _cloud_module('cloud_rackspace').create_image(
+        server_id, name, description,
+        block_device_mapping=block_device_mapping,
+        fingerprint=fingerprint)
 
-    image_id = nova.servers.create_image(data['id'], name)
-    image = nova.images.get(image_id).status.lower()
-    log_green('creating rackspace image...')
-    while nova.images.get(image_id).status.lower() not in ['active', 'error']:
-        log_green('building rackspace image...')
-        sleep_for_one_minute()
 
-    if image == 'error':
-        log_red('error creating image')
-        sys.exit(1)
+def current_instance_name():
+    """ returns the name of the instance the lifecycle tasks act on """
+    return env.get('instance_name', 'default')
 
-    return image_id
+
+def copy_ami(ami, regions, name, description, fingerprint=None):
+    """ copies an ami from env.ec2_region to a list of regions
+
+        all copies are started concurrently and polled together, a single
+        wait covers every region.
+        p fingerprint: the provisioning fingerprint to tag the copies with
+        returns a dict of {region: ami id or False}
+    """
+    return _cloud_module('cloud_ec2').copy_ami(ami, regions, name, description,
+                                               fingerprint=fingerprint)
 
 
 def create_docker_group():
@@ -159,106 +745,73 @@ def create_docker_group():
     from fabric.contrib.files import contains
 
     if not contains('/etc/group', 'docker', use_sudo=True):
-        sudo("groupadd docker")
+        _sudo("groupadd docker")
 
 
-def create_server_ec2():
-    """
-    Creates EC2 Instance and saves it state in a local json file
-    """
-    # looks for an existing 'data.json' file, so that we don't start
-    # additional ec2 instances when we don't need them.
-    #
-    if is_there_state():
-        return True
-    else:
-        conn = connect_to_ec2()
+def create_fleet(count, role=None):
+    """ proxy call for the create fleet function of the cloud backend """
+    return(_cloud_action('create_fleet')(count, role=role))
 
-        log_green("Started...")
-        log_yellow("...Creating EC2 instance...")
-
-        # we need a larger boot device to store our cached images
-        dev_sda1 = EBSBlockDeviceType()
-        dev_sda1.size = 250
-        bdm = BlockDeviceMapping()
-        bdm['/dev/sda1'] = dev_sda1
-
-        # get an ec2 ami image object with our choosen ami
-        image = conn.get_all_images(env.ec2_ami)[0]
-        # start a new instance
-        reservation = image.run(1, 1,
-                                key_name=env.ec2_key_pair,
-                                security_groups=env.ec2_security,
-                                block_device_map=bdm,
-                                instance_type=env.ec2_instancetype)
-
-        # and get our instance_id
-        instance = reservation.instances[0]
-        # add a tag to our instance
-        conn.create_tags([instance.id], {"name": 'jenkins-slave-img'})
-        #  and loop and wait until ssh is available
-        while instance.state == u'pending':
-            log_yellow("Instance state: %s" % instance.state)
-            sleep(10)
-            instance.update()
-        wait_for_ssh(instance.public_dns_name)
-
-        log_green("Instance state: %s" % instance.state)
-        log_green("Public dns: %s" % instance.public_dns_name)
-        # finally save the details or our new instance into the local state file
-        save_state_locally(instance.id)
 
+def create_fleet_ec2(count, role=None):
+    """
+    Creates count EC2 Instances with a single API request, waits for all of
+    them together and saves their state as <instance_name>-<n>, after the
+    first free indexes
 
-def create_server_rackspace():
+    p role: role recorded in the state of every instance, and tagged on it
     """
-    Creates Rackspace Instance and saves it state in a local json file
+    return _cloud_module('cloud_ec2').create_fleet(count, role=role)
+
+
+def create_fleet_rackspace(count, role=None):
     """
-    # looks for an existing 'data.json' file, so that we don't start
-    # additional ec2 instances when we don't need them.
-    #
-    from time import sleep
-    from sys import exit
+    Creates count Rackspace Instances with concurrent API requests, waits
+    for all of them together and saves their state as <instance_name>-<n>,
+    after the first free indexes
 
-    if is_there_state():
-        return True
+    p role: role recorded in the state of every instance
+    """
+    return _cloud_module('cloud_rackspace').create_fleet(count, role=role)
 
-    # looks like no state file is available, lets create a new server instance
-    nova = connect_to_rackspace()
-    log_yellow("Creating Rackspace instance...")
 
-    flavor = nova.flavors.find(name=env.rackspace_flavor)
-    image = nova.images.find(name=env.rackspace_image)
+def create_server_ec2():
+    """
+    Creates EC2 Instance and saves it state in a local json file
 
-    # nova.keypairs.create(env.rackspace_key_pair, env.rackspace_public_key)
+    when env.provisioning_recipe is set and an ami built from the same
+    recipe exists, the instance boots from that ami instead of env.ec2_ami
+    and provision() has nothing left to do.
+    """
+    return _cloud_module('cloud_ec2').create_server()
 
-    server = nova.servers.create(name=env.rackspace_instance_name,
-                                 flavor=flavor.id,
-                                 image=image.id,
-                                 region=env.os_region_name,
-                                 availability_zone=env.os_region_name,
-                                 key_name=env.rackspace_key_pair)
 
-    while server.status == 'BUILD':
-        log_yellow("Waiting for build to finish...")
-        sleep(5)
-        server = nova.servers.get(server.id)
+def create_server_rackspace():
+    """
+    Creates Rackspace Instance and saves it state in a local json file
 
-    # check for errors
-    if server.status != 'ACTIVE':
-        log_red("Error creating rackspace instance")
-        exit(1)
+    when env.provisioning_recipe is set and an image built from the same
+    recipe exists, the server boots from that image instead of
+    env.rackspace_image and provision() has nothing left to do.
+    """
+    return _cloud_module('cloud_rackspace').create_server()
 
-    # the server was assigned IPv4 and IPv6 addresses, locate the IPv4 address
-    ip_address = server.accessIPv4
 
-    if ip_address is None:
-        log_red('No IP address assigned')
-        exit(1)
+def _discard_pool_member(name):
+    """ destroys a pool member and forgets it. a member which can't be
+        destroyed stays in the state store, for retire_stale_pool_members()
+        to try again later
 
-    wait_for_ssh(ip_address)
-    log_green('New server with IP address {0}.'.format(ip_address))
-    # finally save the details or our new instance into the local state file
-    save_state_locally(server.id)
+        returns True if the member was destroyed
+    """
+    with _pool_member_settings(name):
+        try:
+            destroy()
+        except (Exception, SystemExit) as e:
+            log_red('failed to destroy pool member %s: %s' % (name, e))
+            return False
+    delete_state(name)
+    return True
 
 
 def disable_selinux():
@@ -275,84 +828,273 @@ def disable_selinux():
         sed('/etc/selinux/config',
             'SELINUXTYPE=enforcing', 'SELINUX=targeted', use_sudo=True)
 
-    if sudo('getenforce') != 'Disabled':
+    if _sudo('getenforce') != 'Disabled':
         ec2_host = "%s@%s" % (env.user, load_state_from_disk()['ip_address'])
         execute(down, hosts=ec2_host)
         execute(up, hosts=ec2_host)
 
 
-def does_container_exist(container):
-    from fabric.api import settings
-    with settings(warn_only=True):
-        result = sudo('docker inspect %s' % container)
-        print('*********************************************')
-        log_red(result.return_code)
-    if result.return_code is 0:
-        return True
+def distribute_docker_images(images, hosts=None, role=None, seed=None,
+                             concurrency=None):
+    """ pulls docker images once and streams them to a list of hosts
+
+        the images are pulled on a seed host, or on the control machine
+        with seed='local', then streamed to the other hosts through
+        docker save | ssh | docker load pipelines over compressed ssh
+        connections, several hosts at a time. images a host already has
+        are skipped, and so are the layers it already has: docker load
+        doesn't read the layers it finds in its store, so they are left out
+        of the stream.
+
+        p hosts: hosts to stream the images to
+        p role: stream to every instance with this role in the state store
+        p seed: the host to pull the images on, defaults to the first host
+        p concurrency: number of hosts streamed to at a time, defaults to
+                       env.docker_stream_concurrency or 4
+
+        returns a dict of {host: {image: True|False}}, True if the image is
+        present on the host afterwards
+    """
+    hosts = list(hosts or [])
+    if role is not None:
+        hosts += [data['ip_address'] for data in find_instances(role=role)]
+    if not hosts:
+        return {}
+    if concurrency is None:
+        concurrency = env.get('docker_stream_concurrency', 4)
+    seed = seed or hosts[0]
+    images = [_docker_image_key(image) for image in images]
+
+    if seed == 'local':
+        with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                      warn_only=True):
+            for image in images:
+                _local('docker image inspect %s >/dev/null 2>&1 || '
+                      'docker pull -q %s' % (image, image), capture=True)
     else:
-        return False
+        with settings(host_string=seed):
+            cache_docker_images_locally(images)
+
+    available, _ = _docker_host_images(seed)
+    for image in images:
+        if image not in available:
+            log_red('failed to pull %s on %s' % (image, seed))
+
+    def _stream(host):
+        present, chains = _docker_host_images(host)
+        missing = [image for image in images
+                   if image in available and image not in present]
+        if missing:
+            # a layer can be left out when the host has the same layer on
+            # top of the same parents, unless another image needs it
+            needed = set()
+            skip = set()
+            for image in missing:
+                layers = available[image]['layers']
+                for n, layer in enumerate(layers):
+                    if tuple(layers[:n + 1]) in chains:
+                        skip.add(layer)
+                    else:
+                        needed.add(layer)
+            skip -= needed
+            log_green('streaming %s to %s (%d layers already there)...' % (
+                ' '.join(missing), host, len(skip)))
+            _stream_docker_images(seed, host, missing, skip)
+            present, _ = _docker_host_images(host)
+            for host_string in [host, '%s@%s' % (env.user, host)]:
+                invalidate_docker_inventory(host_string)
+        return dict((image, image in present) for image in images)
+
+    targets = [host for host in hosts if host != seed]
+    results = dict(zip(targets, _parallel_map(_stream, targets,
+                                              concurrency)))
+    if seed != 'local':
+        results[seed] = dict((image, image in available)
+                             for image in images)
+    return results
+
+
+def _docker_container(container):
+    """ returns the inventory entry for a container name or id, or None """
+    containers = docker_inventory()['containers']
+    if container in containers:
+        return containers[container]
+    for entry in containers.values():
+        if len(container) >= 12 and entry['id'].startswith(container):
+            return entry
+    return None
+
+
+def _docker_image(image):
+    """ returns the inventory entry for an image reference, or None """
+    images = docker_inventory()['images']
+    return images.get(_docker_image_key(image))
+
+
+def _docker_host_images(host):
+    """ returns the docker images on a host, or on the control machine for
+        'local', as ({repo:tag or repo@digest: {'id': id, 'layers': [diff
+        ids]}}, set of layer chains present)
+    """
+    result = _docker_shell(host,
+                           "docker image inspect --format "
+                           "'{{.Id}}\\t{{json .RepoTags}}\\t"
+                           "{{json .RepoDigests}}\\t"
+                           "{{json .RootFS.Layers}}' "
+                           "$(docker images -q) 2>/dev/null")
+    images = {}
+    chains = set()
+    for line in result.splitlines():
+        fields = line.strip().split('\t')
+        if len(fields) != 4:
+            continue
+        layers = json.loads(fields[3]) or []
+        for n in range(len(layers)):
+            chains.add(tuple(layers[:n + 1]))
+        for ref in (json.loads(fields[1]) or []) + \
+                (json.loads(fields[2]) or []):
+            images[_docker_image_key(ref)] = {'id': fields[0],
+                                              'layers': layers}
+    return images, chains
+
+
+def _docker_shell_argv(host, command):
+    """ returns the argv running a shell command on a host through ssh, as
+        root, or on the control machine for 'local'
+    """
+    import shlex
+
+    if host == 'local':
+        return ['sh', '-c', command]
+    return shlex.split(ssh_command(host)) + [
+        '%s@%s' % (env.user, host), 'sudo sh -c %s' % _shell_quote(command)]
+
+
+def _docker_shell(host, command):
+    """ runs a shell command with _docker_shell_argv(), returns its output
+    """
+    import subprocess
+    from time import time
+
+    started = time()
+    process = subprocess.Popen(_docker_shell_argv(host, command),
+                               stdout=subprocess.PIPE)
+    output = process.communicate()[0].decode('utf-8')
+    _record_trace('local', sys._getframe(1).f_code.co_name, command,
+                  started, host=host, exit_code=process.returncode,
+                  output_bytes=len(output))
+    return output
+
+
+def _docker_image_key(image):
+    """ normalises an image reference the way docker does: images from the
+        docker hub drop their docker.io/ (or index.docker.io/) and library/
+        prefixes, and 'repo' and 'repo:latest' are the same image
+    """
+    for registry in ['docker.io/', 'index.docker.io/']:
+        if image.startswith(registry):
+            image = image[len(registry):]
+            break
+    if image.startswith('library/') and \
+            image.split('@', 1)[0].count('/') == 1:
+        image = image[len('library/'):]
+
+    if '@' in image:
+        return image
+    # a ':' before the last '/' belongs to a registry host:port
+    if ':' not in image.rsplit('/', 1)[-1]:
+        if len(image) == 12 and all(c in '0123456789abcdef' for c in image):
+            return image  # an image id
+        return '%s:latest' % image
+    return image
+
+
+def _index_docker_image(images, repository, tag, image_id, digest):
+    """ adds an image to the docker inventory index """
+    entry = {'repository': repository, 'tag': tag,
+             'id': image_id, 'digest': digest}
+    images[image_id] = entry
+    if repository != '<none>':
+        if tag != '<none>':
+            images[_docker_image_key('%s:%s' % (repository, tag))] = entry
+        if digest and digest != '<none>':
+            images[_docker_image_key('%s@%s' % (repository,
+                                                digest))] = entry
+
+
+def docker_inventory():
+    """ returns an index of the docker images and containers on the current
+        host, as {'images': {ref: entry}, 'containers': {name: entry}}
+
+        images are indexed by repo:tag, repo@digest and short id, containers
+        by name and id. the inventory is fetched with a single remote call
+        and cached for the session.
+    """
+    if env.host_string in _DOCKER_INVENTORY:
+        return _DOCKER_INVENTORY[env.host_string]
+
+    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                  warn_only=True, capture=True):
+        result = _sudo("docker images --digests --format '%s'; echo ---; "
+                      "docker ps -a --format '%s'" % (DOCKER_IMAGES_FORMAT,
+                                                      DOCKER_PS_FORMAT))
+
+    inventory = {'images': {}, 'containers': {}}
+    images_output, _, containers_output = result.partition('---')
+    for line in images_output.splitlines():
+        fields = line.strip().split('\t')
+        if len(fields) == 4:
+            _index_docker_image(inventory['images'], *fields)
+    for line in containers_output.splitlines():
+        fields = line.strip().split('\t')
+        if len(fields) == 4:
+            entry = {'id': fields[0], 'name': fields[1],
+                     'image': fields[2], 'status': fields[3]}
+            inventory['containers'][fields[0]] = entry
+            inventory['containers'][fields[1]] = entry
+
+    _DOCKER_INVENTORY[env.host_string] = inventory
+    return inventory
+
+
+def does_container_exist(container):
+    """ checks if a container exists, by name or id """
+    return _docker_container(container) is not None
+
+
+def delete_state(name=None):
+    """ removes an instance from the state store
+        p name: the instance name, defaults to env.instance_name
+    """
+    name = name or current_instance_name()
+
+    def _delete(store):
+        return store['instances'].pop(name, None)
+
+    update_state_store(_delete)
+    if (name == current_instance_name() and env.get('data_json', True) and
+            os.path.isfile('data.json')):
+        os.unlink('data.json')
 
 
 def destroy():
     if is_there_state():
-        if env.cloud == 'ec2':
-            destroy_ec2()
-        if env.cloud == 'rackspace':
-            destroy_rackspace()
+        _cloud_action('destroy')()
 
 
 def destroy_ec2():
     """ terminates the instance """
-    if is_there_state() is False:
-        return True
-    else:
-        conn = connect_to_ec2()
-        _state = load_state_from_disk()
-        data = get_ec2_info(_state['id'])
-        instance = conn.terminate_instances(instance_ids=[data['id']])[0]
-        log_yellow('destroying instance ...')
-        while instance.state != "terminated":
-            log_yellow("Instance state: %s" % instance.state)
-            sleep(10)
-            instance.update()
-        volume = data['volume']
-        if volume:
-            log_yellow('destroying EBS volume ...')
-            conn.delete_volume(volume)
-        os.unlink('data.json')
+    return _cloud_module('cloud_ec2').destroy()
 
 
 def destroy_rackspace():
     """ terminates the instance """
-    from time import sleep
-    if is_there_state() is False:
-        return True
-
-    nova = connect_to_rackspace()
-    _state = load_state_from_disk()
-    server = nova.servers.get(_state['id'])
-    log_yellow('deleting rackspace instance ...')
-    server.delete()
-
-    # wait for server to be deleted
-    try:
-        while True:
-            server = nova.servers.get(server.id)
-            log_yellow('waiting for deletion ...')
-            sleep(5)
-    except:
-        pass
-    log_green('The server has been deleted')
+    return _cloud_module('cloud_rackspace').destroy()
 
 
 def does_image_exist(image):
-    from fabric.api import settings
-    with settings(warn_only=True):
-        result = sudo('docker images')
-        if image in result:
-            return True
-        else:
-            return False
+    """ checks if an image exists, by exact repo:tag, repo@digest or id """
+    return _docker_image(image) is not None
 
 
 def down():
@@ -361,23 +1103,11 @@ def down():
 
 def down_ec2():
     """ shutdown of an existing EC2 instance """
-    conn = connect_to_ec2()
-    # checks for a valid state file, containing the details our ec2 instance
-    if is_there_state() is False:
-        # we can't shutdown the instance, if we don't know which one it is
-        return False
-    else:
-        # get the instance_id from the state file, and stop the instance
-        data = load_state_from_disk()
-        instance = conn.stop_instances(instance_ids=[data['id']])[0]
-        while instance.state != "stopped":
-            log_yellow("Instance state: %s" % instance.state)
-            sleep(10)
-            instance.update()
+    return _cloud_module('cloud_ec2').halt()
 
 
 def down_rackspace():
-    pass
+    return _cloud_module('cloud_rackspace').halt()
 
 
 def ec2():
@@ -390,46 +1120,352 @@ def enable_firewalld_service():
     systemd(service='firewalld', unmask=True)
 
 
-def get_container_id(container):
-        result = sudo("docker ps -a | grep %s | awk '{print $1}'" % container)
-        return result
+def export_state_to_json(name=None, path='data.json'):
+    """ writes a single instance from the state store in the legacy
+        data.json format
+    """
+    data = load_state_from_disk(name)
+    if data:
+        _write_json_atomically(path, data)
 
 
-def get_ec2_info(instance_id):
-    """ queries EC2 for details about a particular instance_id
+def find_instances(instance_id=None, ip_address=None, role=None,
+                   cloud_type=None, tag=None):
+    """ returns the state of all instances matching every filter given
+
+        p tag: a (key, value) tuple or a 'key=value' string
     """
-    conn = connect_to_ec2()
-    instance = conn.get_only_instances(
-        filters={'instance_id': instance_id}
-        )[0]
+    store = load_state_store()
+    index = _state_index()
+
+    names = set(store['instances'])
+    if tag is not None and not isinstance(tag, tuple):
+        tag = tuple(tag.split('=', 1))
+    for field, value in [('id', instance_id),
+                         ('ip_address', ip_address),
+                         ('role', role),
+                         ('cloud_type', cloud_type),
+                         ('tag', tag)]:
+        if value is not None:
+            names &= index[field].get(value, set())
+
+    return [store['instances'][name] for name in sorted(names)]
+
+
+def find_ec2_image(fingerprint):
+    """ returns the id of the newest available ami tagged with a
+        provisioning fingerprint, or None
+    """
+    return _cloud_module('cloud_ec2').find_image(fingerprint)
+
+
+def find_golden_image(fingerprint=None):
+    """ proxy call for the find image function of the cloud backend, returns
+        the id of an image built from the provisioning recipe, or None
+
+        p fingerprint: defaults to the fingerprint of env.provisioning_recipe
+    """
+    return(_cloud_action('find_image')(
+        fingerprint or provisioning_fingerprint()))
+
+
+def find_rackspace_image(fingerprint):
+    """ returns the id of an active rackspace image whose metadata carries a
+        provisioning fingerprint, or None
+    """
+    return _cloud_module('cloud_rackspace').find_image(fingerprint)
+
+
+def fill_pool(role=None, size=None):
+    """ tops the warm pool of a role up to size instances
+
+        new members are created as one fleet, provisioned with
+        env.provisioning_recipe unless they booted from its golden image,
+        then stopped unless env.pool_state is 'running'. each member joins
+        the pool once it is ready, one which fails to get there is
+        destroyed. stale members are retired first, see
+        retire_stale_pool_members().
+
+        p role: defaults to env.instance_role
+        p size: defaults to env.pool_size
+
+        returns the names of the new members
+    """
+    import uuid
+    from time import time
+
+    role = role or env.get('instance_role', None)
+    size = int(size if size is not None else env.get('pool_size', 0))
+
+    retire_stale_pool_members(role)
+    prefix = 'pool-%s-%s' % (role or 'default', uuid.uuid4().hex[:8])
+
+    # the missing members are reserved under the state store lock, so that
+    # fill_pool() runs started together don't each create all of them.
+    # create_fleet() names its instances <prefix>-<n>, which replaces the
+    # reservations, and members can't be claimed until they are provisioned
+    def _reserve(store):
+        members = [data for data in store['instances'].values()
+                   if data.get('pool') and data.get('role') == role]
+        reserved = ['%s-%d' % (prefix, n)
+                    for n in range(size - len(members))]
+        for name in reserved:
+            store['instances'][name] = {'name': name, 'id': None,
+                                        'role': role, 'pool': 'warming',
+                                        'pool_since': time()}
+        return reserved
+
+    def _release(store):
+        for name in reserved:
+            if store['instances'].get(name, {}).get('id') is None:
+                store['instances'].pop(name, None)
+
+    reserved = update_state_store(_reserve)
+    if not reserved:
+        return []
+
+    log_green('adding %d instances to the warm pool...' % len(reserved))
+    try:
+        with _pool_member_settings(prefix):
+            fleet = create_fleet(len(reserved), role=role)
+    finally:
+        # drop the reservations create_fleet() didn't fill
+        update_state_store(_release)
+
+    def _ready(store, name):
+        if name in store['instances']:
+            store['instances'][name]['pool'] = 'ready'
+
+    # each member is handed to the pool as soon as it is prepared
+    ready = []
+    for name in sorted(fleet):
+        with _pool_member_settings(name,
+                                   host_string=fleet[name]['ip_address']):
+            try:
+                if env.get('provisioning_recipe'):
+                    provision(image=False)
+                if env.get('pool_state', 'stopped') == 'stopped':
+                    down()
+            except (Exception, SystemExit) as e:
+                log_red('failed to prepare pool member %s: %s' % (name, e))
+                _discard_pool_member(name)
+                continue
+        update_state_store(lambda store: _ready(store, name))
+        ready.append(name)
+    return ready
+
+
+def export_trace(path='trace.json', output_format='chrome'):
+    """ writes the trace recorded in this session to a json file
+
+        p output_format: 'chrome' for the Trace Event format understood
+                         by chrome://tracing and Perfetto, 'json' for the
+                         raw events
+    """
+    events = list(_TRACE)
+    if output_format != 'chrome':
+        _write_json_atomically(path, events)
+        return
+
+    origin = min([e['start'] for e in events] or [0])
+    pids = {}
+    trace = []
+    for e in events:
+        if e['host'] not in pids:
+            pids[e['host']] = len(pids) + 1
+            trace.append({'name': 'process_name', 'ph': 'M',
+                          'pid': pids[e['host']],
+                          'args': {'name': e['host']}})
+        trace.append({'name': e['function'],
+                      'cat': e['kind'],
+                      'ph': 'X',
+                      'ts': int((e['start'] - origin) * 1000000),
+                      'dur': int(e['duration'] * 1000000),
+                      'pid': pids[e['host']],
+                      'tid': e['thread'],
+                      'args': {'command': e['command'],
+                               'exit_code': e['exit_code'],
+                               'output_bytes': e['output_bytes']}})
+    _write_json_atomically(path, {'traceEvents': trace})
+    log_green('trace of %d events written to %s' % (len(events), path))
+
+
+def get_container_id(container):
+    """ returns the id of a container, by name or id """
+    entry = _docker_container(container)
+    return entry['id'] if entry else ''
 
+
+def _ec2_instance_data(instance, volume):
+    """ returns the state we keep for an ec2 instance object """
     data = {}
     data['public_dns_name'] = instance.public_dns_name
     data['id'] = instance.id
     data['ip_address'] = instance.ip_address
     data['architecture'] = instance.architecture
     data['state'] = instance.state
-    try:
-        volume = conn.get_all_volumes(
-            filters={'attachment.instance-id': instance.id})[0].id
-        data['volume'] = volume
-    except:
-        data['volume'] = ''
+    data['tags'] = dict(instance.tags)
+    data['volume'] = volume
     return data
 
 
+def _ec2_filter_chunks(values):
+    """ splits a list of filter values into lists ec2 accepts in a single
+        describe request, see EC2_FILTER_VALUES_LIMIT
+    """
+    values = list(values)
+    return [values[n:n + EC2_FILTER_VALUES_LIMIT]
+            for n in range(0, len(values), EC2_FILTER_VALUES_LIMIT)]
+
+
+def _ec2_paginate(method, **kwargs):
+    """ calls a boto describe method until all pages have been fetched """
+    results = []
+    while True:
+        page = method(**kwargs)
+        results.extend(page)
+        token = getattr(page, 'next_token', None)
+        if not token:
+            return results
+        kwargs['next_token'] = token
+
+
+def _ec2_volumes_by_instance(conn, instance_ids, volumes=None):
+    """ returns {instance_id: volume_id} for a list of instances, using a
+        single volumes query
+
+        p volumes: volumes already fetched, saves querying for them again
+    """
+    if volumes is None:
+        volumes = []
+        for chunk in _ec2_filter_chunks(instance_ids):
+            volumes += _ec2_paginate(
+                conn.get_all_volumes,
+                filters={'attachment.instance-id': chunk})
+    by_instance = {}
+    for volume in volumes:
+        by_instance.setdefault(volume.attach_data.instance_id, volume.id)
+    return by_instance
+
+
+def fleet_status(output_format='table', role=None):
+    """ outputs the state of every instance in the state store
+
+        p output_format: 'table' or 'json'
+        p role: only show instances with this role
+
+        all ec2 instances and their volumes are fetched with one filtered,
+        paginated describe request per resource type and 200 instances,
+        all rackspace servers with one list request, and the results are
+        joined locally. the fresh state and addresses are saved back to the
+        state store.
+    """
+    tracked = find_instances(role=role)
+    ids = {'ec2': [], 'rackspace': []}
+    for data in tracked:
+        ids.setdefault(data.get('cloud_type'), []).append(data['id'])
+
+    fresh = {}
+    if ids['ec2']:
+        conn = connect_to_ec2()
+        calls = []
+        for chunk in _ec2_filter_chunks(ids['ec2']):
+            # ec2 refuses max_results together with instance_ids, so the
+            # ids go in a filter
+            calls.append(cloud_call('ec2', _ec2_paginate,
+                                    conn.get_only_instances,
+                                    filters={'instance-id': chunk},
+                                    max_results=1000))
+            calls.append(cloud_call('ec2', _ec2_paginate,
+                                    conn.get_all_volumes,
+                                    filters={'attachment.instance-id': chunk}))
+        pages = gather(*calls)
+        instances = [i for page in pages[0::2] for i in page]
+        volumes = [v for page in pages[1::2] for v in page]
+        by_instance = _ec2_volumes_by_instance(conn, ids['ec2'], volumes)
+        for instance in instances:
+            fresh[instance.id] = _ec2_instance_data(
+                instance, by_instance.get(instance.id, ''))
+    if ids['rackspace']:
+        nova = connect_to_rackspace()
+        for server in nova.servers.list():
+            if server.id in ids['rackspace']:
+                fresh[server.id] = _rackspace_server_data(server)
+
+    def _refresh(store):
+        for data in store['instances'].values():
+            if data['id'] in fresh:
+                data.update(fresh[data['id']])
+
+    update_state_store(_refresh)
+
+    rows = []
+    for data in tracked:
+        row = dict(data)
+        row.update(fresh.get(data['id'], {'state': 'missing'}))
+        rows.append(row)
+
+    if output_format == 'json':
+        print(json.dumps(rows, indent=2, sort_keys=True))
+        return rows
+
+    columns = ['name', 'role', 'cloud_type', 'id', 'state', 'ip_address',
+               'volume']
+    widths = dict((c, max([len(c)] + [len(str(row.get(c) or ''))
+                                      for row in rows]))
+                  for c in columns)
+    log_green('  '.join(c.ljust(widths[c]) for c in columns))
+    for row in rows:
+        line = '  '.join(str(row.get(c) or '').ljust(widths[c])
+                         for c in columns)
+        if row['state'] in ['running', 'ACTIVE']:
+            log_green(line)
+        else:
+            log_yellow(line)
+    return rows
+
+
+def gather(*futures):
+    """ waits for a list of CloudFutures, returning their results in order
+    """
+    return [future.result() for future in futures]
+
+
+def get_ec2_info(instance_id):
+    """ queries EC2 for details about a particular instance_id
+    """
+    conn = connect_to_ec2()
+    # the instance and its volumes are independent queries, run them
+    # side by side
+    instances, volumes = gather(
+        cloud_call('ec2', conn.get_only_instances,
+                   filters={'instance_id': instance_id}),
+        cloud_call('ec2', conn.get_all_volumes,
+                   filters={'attachment.instance-id': instance_id}))
+    instance = instances[0]
+
+    try:
+        volume = volumes[0].id
+    except IndexError:
+        volume = ''
+    return _ec2_instance_data(instance, volume)
+
+
 def get_image_id(image):
-        result = sudo("docker images | grep %s | awk '{print $3}'" % image)
-        return result
+    """ returns the id of an image, by repo:tag or repo@digest """
+    entry = _docker_image(image)
+    return entry['id'] if entry else ''
 
 
-def get_ip_address_from_rackspace_server(server_id):
+def get_ip_address_from_rackspace_server(server_id, server=None):
     """
     returns an ipaddress for a rackspace instance
+    p server: an already fetched server object, saves querying for it again
     """
     import re
-    nova = connect_to_rackspace()
-    server = nova.servers.get(server_id)
+    if server is None:
+        nova = connect_to_rackspace()
+        server = nova.servers.get(server_id)
     # the server was assigned IPv4 and IPv6 addresses, locate the IPv4 address
     ip_address = None
     for network in server.networks['public']:
@@ -450,91 +1486,289 @@ def get_rackspace_info(server_id):
     """
     nova = connect_to_rackspace()
     server = nova.servers.get(server_id)
-
-    data = {}
-    data['id'] = server.id
-    # this needs to be tackled
-    data['ip_address'] = get_ip_address_from_rackspace_server(server.id)
-    data['state'] = server.status
-
-    # TODO: volumes are missing
-    return data
+    return _rackspace_server_data(server)
 
 
 def git_clone(repo_url, repo_name):
-    from fabric.api import run
     from fabric.contrib.files import exists
     """ clones a git repository """
     if not exists(repo_name):
-        run("git clone %s" % repo_url)
+        _run("git clone %s" % repo_url)
+
+
+def _golden_image():
+    """ returns (fingerprint, image id) of the golden image built from
+        env.provisioning_recipe, or (None, None) when there is no recipe or
+        no image matches it yet
+    """
+    if not env.get('provisioning_recipe'):
+        return None, None
+
+    fingerprint = provisioning_fingerprint()
+    image = find_golden_image(fingerprint)
+    if image is None:
+        log_yellow('no golden image for recipe %s, '
+                   'full provisioning needed' % fingerprint[:12])
+        return None, None
+    log_green('booting from golden image %s' % image)
+    return fingerprint, image
+
+
+def halt():
+    if is_there_state():
+        _cloud_action('halt')()
 
 
-def halt():
-    if is_there_state():
-        if env.cloud == 'ec2':
-            down_ec2()
-        if env.cloud == 'rackspace':
-            down_rackspace()
+def host_facts():
+    """ returns a dict of facts about the current host
+
+        facts are gathered with a single remote call and cached for the
+        session, keyed by env.host_string. use invalidate_host_facts() when
+        they are no longer valid (ie: after a reboot or an OS update)
+    """
+    if env.host_string in _HOST_FACTS:
+        return _HOST_FACTS[env.host_string]
+
+    script = ("test -r /etc/os-release && . /etc/os-release; "
+              "echo \"id=$ID\"; "
+              "echo \"id_like=$ID_LIKE\"; "
+              "echo \"version_id=$VERSION_ID\"; "
+              "echo \"machine=$(uname -m)\"; "
+              "echo \"kernel=$(uname -r)\"; "
+              "echo \"dist=$(rpm -E %dist 2>/dev/null)\"; "
+              "echo \"init=$(cat /proc/1/comm 2>/dev/null)\"")
+
+    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                  warn_only=True, capture=True):
+        result = _run(script)
+
+    facts = {}
+    for line in result.splitlines():
+        if '=' in line:
+            key, value = line.strip().split('=', 1)
+            facts[key] = value.strip().strip('"').lower()
+
+    # older distributions don't ship /etc/os-release
+    if not facts.get('id'):
+        with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                      warn_only=True, capture=True):
+            release = _run('cat /etc/redhat-release /etc/issue').lower()
+        for distro in ['centos', 'redhat', 'fedora', 'ubuntu', 'debian']:
+            if distro in release:
+                facts['id'] = distro
+                break
+
+    family = ' '.join([facts.get('id', ''), facts.get('id_like', '')])
+    if ('rhel' in family or 'fedora' in family or
+            'centos' in family or 'redhat' in family):
+        facts['os_family'] = 'redhat'
+    elif 'debian' in family or 'ubuntu' in family:
+        facts['os_family'] = 'debian'
+    else:
+        facts['os_family'] = None
+
+    _HOST_FACTS[env.host_string] = facts
+    return facts
+
+
+def import_state_from_json(path='data.json', name=None):
+    """ adds the instance recorded in a legacy data.json file to the state
+        store
+    """
+    with open(path, 'r') as f:
+        data = json.load(f)
+    name = name or current_instance_name()
+    data['name'] = name
+
+    def _import(store):
+        store['instances'][name] = data
+
+    update_state_store(_import)
+
+
+def install_docker():
+    """ installs docker """
+    yum_install(packages=['docker', 'docker-registry'])
+    systemd('docker.service')
+
+
+def install_from_source(url, version=None, creates=None, prefix='/usr/local',
+                        configure='./configure --prefix={prefix}',
+                        build='make',
+                        install='make install DESTDIR={destdir}'):
+    """ builds a source tarball once and deploys the result to every host
+
+        the first host of a distribution and architecture downloads, builds
+        and installs the source into a staging directory. the staged files
+        are packed into an artifact, unpacked into / and copied back into
+        env.build_cache_dir. the hosts after it get the artifact pushed
+        over their ssh connection and only unpack it.
+
+        p url: url of the source tarball
+        p version: the version being built, part of the artifact key
+        p creates: a file the install creates, nothing is done when the
+                   host already has it
+        p configure, build, install: the build commands, run from the
+                   unpacked source. {prefix} stands for prefix, {destdir}
+                   for the staging directory the install must write to.
+
+        returns True if the source was installed, False if creates
+        already existed
+    """
+    import hashlib
+    import tempfile
+    from fabric.context_managers import cd
+
+    if creates:
+        with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                      warn_only=True, capture=True):
+            if _run('test -e %s' % creates).return_code == 0:
+                return False
 
+    facts = host_facts()
+    key = hashlib.sha1(json.dumps(
+        [url, version, prefix, configure, build, install,
+         facts.get('id'), facts.get('version_id'), facts.get('machine')]
+    ).encode('utf-8')).hexdigest()
+    name = '%s-%s%s-%s-%s.tar.gz' % (
+        os.path.basename(url).split('.tar')[0],
+        facts.get('id'), facts.get('version_id'), facts.get('machine'),
+        key[:12])
+
+    cache_dir = os.path.expanduser(env.get('build_cache_dir',
+                                           '.build-cache'))
+    artifact = os.path.join(cache_dir, name)
+    if os.path.isfile(artifact):
+        log_green('installing %s from the build cache' % name)
+        fabric.api.put(artifact, '/tmp/%s' % name)
+        with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                      warn_only=True, capture=True):
+            result = _sudo('tar xzf /tmp/{0} -C / --no-overwrite-dir ; '
+                          '__rc=$?; rm -f /tmp/{0}; exit $__rc'.format(name))
+        if result.return_code != 0:
+            log_red('failed to unpack %s' % name)
+            print(result)
+            raise SystemExit()
+        return True
 
-def install_docker():
-    """ installs docker """
-    yum_install(packages=['docker', 'docker-registry'])
-    systemd('docker.service')
+    log_green('building %s...' % url)
+    workdir = '/tmp/build-%s' % key[:12]
+    with batch():
+        _sudo('mkdir -p %s/src %s/destdir' % (workdir, workdir))
+        _sudo('wget -q -c -O %s/source %s' % (workdir, url))
+        _sudo('tar xf %s/source -C %s/src --strip-components=1' % (
+            workdir, workdir))
+        with cd('%s/src' % workdir):
+            _sudo(configure.format(prefix=prefix))
+            _sudo(build.format(prefix=prefix))
+            _sudo(install.format(prefix=prefix,
+                                destdir='%s/destdir' % workdir))
+        # the artifact holds ./ and the parent directories of prefix, which
+        # mustn't reset the mode and owner of /, /usr... when unpacked
+        _sudo('tar czf {0}/{1} -C {0}/destdir . && '
+             'tar xzf {0}/{1} -C / --no-overwrite-dir'.format(workdir, name))
+
+    # keep the artifact for the next hosts, renamed into place so that a
+    # partial download is never picked up
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass  # created by another thread meanwhile
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        fabric.api.get('%s/%s' % (workdir, name), tmp)
+        os.rename(tmp, artifact)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                  warn_only=True, capture=True):
+        _sudo('rm -rf %s' % workdir)
+    return True
 
 
 def install_gem(gem):
     """ install a particular gem """
-    from fabric.api import settings, run
+    from fabric.api import settings
     from fabric.context_managers import hide
 
     with settings(hide('warnings', 'running', 'stdout', 'stderr'),
                   warn_only=False, capture=True):
-        run("gem install %s --no-rdoc --no-ri" % gem)
+        _run("gem install %s --no-rdoc --no-ri" % gem)
 
 
 def install_recent_git_from_source():
-    from fabric.context_managers import cd
     # update git
-    sudo("wget -c https://www.kernel.org/pub/software/scm/git/git-2.4.6.tar.gz")
-    sudo("test -e git-2.4.6 || tar -zxf git-2.4.6.tar.gz")
-    with cd('git-2.4.6'):
-        sudo('test -e /usr/local/bin/git || ./configure --prefix=/usr/local')
-        sudo('test -e /usr/local/bin/git || make')
-        sudo('test -e /usr/local/bin/git || make install')
+    install_from_source(
+        'https://www.kernel.org/pub/software/scm/git/git-2.4.6.tar.gz',
+        version='2.4.6',
+        creates='/usr/local/bin/git')
 
 
 def install_os_updates():
-    """ installs OS updates """
-    if ('centos' in linux_distribution() or
-            'rhel' in linux_distribution() or
-            'redhat' in linux_distribution()):
-        sudo("yum -y --quiet update")
+    """ installs OS updates
+
+        with env.package_cache_dir set, the updates are downloaded once per
+        distribution and pushed to the other hosts from the local package
+        cache, which is refreshed after env.package_cache_ttl seconds
+    """
+    result = None
+    if _package_cache_dir() and os_family() in ['redhat', 'debian']:
+        ttl = env.get('package_cache_ttl', 86400)
+        if os_family() == 'redhat':
+            # the update catches anything released since the download
+            result = _cached_package_install(
+                'yum update',
+                download="yum -y --quiet update --downloadonly "
+                         "--downloaddir={dir}",
+                install="yum -y --quiet install {files}; "
+                        "yum -y --quiet update",
+                ttl=ttl)
+        else:
+            # apt finds the pushed packages in its archives directory
+            result = _cached_package_install(
+                'apt-get upgrade',
+                download="apt-get update && apt-get -y upgrade "
+                         "--download-only -o Dir::Cache::archives={dir}",
+                install="apt-get update && apt-get -y upgrade "
+                        "-o Dir::Cache::archives={dir}",
+                ttl=ttl)
+        if result is not None and result.return_code != 0:
+            print(result)
+            raise SystemExit()
 
-    if ('ubuntu' in linux_distribution() or
-            'debian' in linux_distribution()):
-        sudo("apt-get update")
-        sudo("apt-get -y upgrade")
+    if result is None and os_family() == 'redhat':
+        _sudo("yum -y --quiet update")
+
+    if result is None and os_family() == 'debian':
+        _sudo("apt-get update")
+        _sudo("apt-get -y upgrade")
+
+    # the kernel, os-release and most packages may have changed underneath us
+    invalidate_host_facts()
+    invalidate_package_inventory()
 
 
 def install_python_module(name):
     """ instals a python module using pip """
-    from fabric.api import settings, run
+    from fabric.api import settings
     from fabric.context_managers import hide
 
     with settings(hide('warnings', 'running', 'stdout', 'stderr'),
                   warn_only=False, capture=True):
-        run('pip --quiet install %s' % name)
+        _run('pip --quiet install %s' % name)
 
 
 def install_python_module_locally(name):
     """ instals a python module using pip """
-    from fabric.api import settings, local
+    from fabric.api import settings
     from fabric.context_managers import hide
 
     with settings(hide('warnings', 'running', 'stdout', 'stderr'),
                   warn_only=False, capture=True):
-        local('pip --quiet install %s' % name)
+        _local('pip --quiet install %s' % name)
 
 
 def install_system_gem(gem):
@@ -544,98 +1778,136 @@ def install_system_gem(gem):
 
     with settings(hide('warnings', 'running', 'stdout', 'stderr'),
                   warn_only=False, capture=True):
-        sudo("gem install %s --no-rdoc --no-ri" % gem)
+        _sudo("gem install %s --no-rdoc --no-ri" % gem)
 
 
 def install_zfs_from_testing_repository():
     # Enable debugging for ZFS modules
-    sudo("echo SPL_DKMS_DISABLE_STRIP=y >> /etc/sysconfig/spl")
-    sudo("echo ZFS_DKMS_DISABLE_STRIP=y >> /etc/sysconfig/zfs")
-    sudo("yum install --quiet -y --enablerepo=zfs-testing zfs")
+    with batch():
+        _sudo("echo SPL_DKMS_DISABLE_STRIP=y >> /etc/sysconfig/spl")
+        _sudo("echo ZFS_DKMS_DISABLE_STRIP=y >> /etc/sysconfig/zfs")
+        _sudo("yum install --quiet -y --enablerepo=zfs-testing zfs")
+    update_package_inventory(['zfs'])
+
+
+def invalidate_cloud_connections():
+    """ drops all the pooled cloud connections, forcing a reconnect """
+    with _CLOUD_CONNECTIONS_LOCK:
+        _CLOUD_CONNECTIONS.clear()
+
+
+def invalidate_docker_inventory(host_string=None):
+    """ drops the docker inventory for a host, defaults to the current host
+    """
+    _DOCKER_INVENTORY.pop(host_string or env.host_string, None)
+
+
+def invalidate_host_facts(host_string=None):
+    """ drops the cached facts for a host, defaults to the current host """
+    _HOST_FACTS.pop(host_string or env.host_string, None)
+
+
+def invalidate_package_inventory(host_string=None):
+    """ drops the package inventory for a host, defaults to the current host
+    """
+    _PACKAGE_INVENTORY.pop(host_string or env.host_string, None)
 
 
 def is_deb_package_installed(pkg):
     """ checks if a particular deb package is installed """
+    return pkg in package_inventory()
 
-    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
-                  warn_only=True, capture=True):
 
-        result = sudo("dpkg -l %s" % pkg)
-        if result.return_code == 0:
-            return True
-        elif result.return_code == 1:
-            return False
-        else:  # print error to user
-            print(result)
-            raise SystemExit()
+def _is_throttled(error):
+    """ checks if a cloud API error means we are being rate limited """
+    return (getattr(error, 'error_code', None) in ['RequestLimitExceeded',
+                                                   'Throttling'] or
+            getattr(error, 'http_status', None) == 413 or
+            error.__class__.__name__ == 'OverLimit')
 
 
 def is_package_installed(pkg):
     """ checks if a particular package is installed """
-    if ('centos' in linux_distribution() or
-            'rhel' in linux_distribution() or
-            'redhat' in linux_distribution()):
+    if os_family() == 'redhat':
         return(is_rpm_package_installed(pkg))
 
-    if ('ubuntu' in linux_distribution() or
-            'debian' in linux_distribution()):
+    if os_family() == 'debian':
         return(is_deb_package_installed(pkg))
 
 
 def is_rpm_package_installed(pkg):
     """ checks if a particular rpm package is installed """
+    return pkg in package_inventory()
 
-    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
-                  warn_only=True, capture=True):
-
-        result = sudo("rpm -q %s" % pkg)
-        if result.return_code == 0:
-            return True
-        elif result.return_code == 1:
-            return False
-        else:   # print error to user
-            print(result)
-            raise SystemExit()
 
+def is_there_state(name=None):
+    """ checks is there is valid state available on disk
+        p name: the instance name, defaults to env.instance_name
+    """
+    return (name or current_instance_name()) in load_state_store()['instances']
 
-def is_there_state():
-    """ checks is there is valid state available on disk """
-    if os.path.isfile('data.json'):
-        return True
-    else:
-        return False
 
+def is_ssh_available(host, port=22, timeout=5):
+    """ checks if sshd is answering on host:port
 
-def is_ssh_available(host, port=22):
-    """ checks if ssh port is open """
-    s = socket.socket()
+        a connection is only considered available once the server has sent
+        its 'SSH-' banner, an open port alone isn't enough
+        p timeout: seconds to wait for the connection and the banner
+    """
     try:
-        s.connect((host, port))
-        return True
-    except socket.error:
+        s = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    try:
+        return s.recv(4).startswith(b'SSH-')
+    except (socket.error, socket.timeout):
         return False
+    finally:
+        s.close()
 
 
 def linux_distribution():
     """ returns the linux distribution in lower case """
-    from fabric.api import run, settings
-    from fabric.context_managers import hide
+    return host_facts().get('id') or None
 
-    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
-                  warn_only=True, capture=True):
-        if 'centos' in run('cat /etc/os-release').lower():
-            return('centos')
+
+def load_state_from_disk(name=None):
+    """ loads the state of an instance from the local state store
+        p name: the instance name, defaults to env.instance_name
+    """
+    return load_state_store()['instances'].get(
+        name or current_instance_name(), False)
 
 
-def load_state_from_disk():
-    """ loads the state from a loca data.json file
+def load_state_store():
+    """ returns the local state store, a dict of
+        {'instances': {name: state}}
+
+        the store lives in env.state_file (default: state.json) and is only
+        re-read from disk when it changes. a legacy data.json file is
+        imported the first time, if there is no store yet.
     """
-    if is_there_state():
-        with open('data.json', 'r') as f:
-            data = json.load(f)
-        return data
-    else:
-        return False
+    if not os.path.isfile(_state_file()) and os.path.isfile('data.json'):
+        import_state_from_json('data.json')
+    return _read_state_store()
+
+
+def _local(command, *args, **kwargs):
+    """ runs fabric's local(), recording it in the trace. private, like
+        _run() and _sudo(), so that fab doesn't list it as a task and
+        'from api import *' leaves fabric's local() alone
+    """
+    return _traced_command('local', fabric.api.local, command, args, kwargs)
+
+
+def _load_rsync_manifests():
+    """ returns the manifests saved by previous rsync() runs, as
+        {source_path: {'files': {...}, 'pushed': {host: digest}}}
+    """
+    if not os.path.isfile(_rsync_manifest_file()):
+        return {}
+    with open(_rsync_manifest_file(), 'r') as f:
+        return json.load(f)
 
 
 def log_green(msg):
@@ -650,84 +1922,749 @@ def log_red(msg):
     print(red(msg))
 
 
+def _manifest_digest(files):
+    """ returns a digest identifying a whole source manifest """
+    import hashlib
+
+    digest = hashlib.sha1()
+    for path in sorted(files):
+        digest.update(('%s\0%s\0' % (path, files[path][2])).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def os_family():
+    """ returns the family of the linux distribution, 'redhat' or 'debian' """
+    return host_facts()['os_family']
+
+
+def _index_package(index, name, version, arch):
+    """ adds a package to a package inventory index """
+    entry = {'name': name, 'version': version, 'arch': arch}
+    for key in _package_index_keys(entry):
+        index.setdefault(key, [])
+        if entry not in index[key]:
+            index[key].append(entry)
+
+
+def _package_cache_dir():
+    """ returns the local package cache directory for the distribution of
+        the current host, or None when env.package_cache_dir isn't set
+    """
+    if not env.get('package_cache_dir'):
+        return None
+
+    facts = host_facts()
+    path = os.path.join(os.path.expanduser(env.package_cache_dir),
+                        '%s-%s-%s' % (facts.get('id'),
+                                      facts.get('version_id'),
+                                      facts.get('machine')))
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass  # created by another thread meanwhile
+    return path
+
+
+def _package_cache_index(cache_dir):
+    """ returns the index of a package cache directory, as
+        {key: {'files': [...], 'time': timestamp}}
+    """
+    path = os.path.join(cache_dir, 'index.json')
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _package_index_keys(entry):
+    """ returns all the keys a package entry is indexed under """
+    keys = [entry['name'],
+            '%(name)s.%(arch)s' % entry,
+            '%(name)s:%(arch)s' % entry,
+            '%(name)s-%(version)s' % entry,
+            '%(name)s-%(version)s.%(arch)s' % entry]
+    # rpm versions carry the release, 'rpm -q name-version' matches too
+    if '-' in entry['version']:
+        keys.append('%s-%s' % (entry['name'],
+                               entry['version'].rsplit('-', 1)[0]))
+    return keys
+
+
+def _query_package_inventory(index, packages=None):
+    """ queries the package manager and adds the results to index
+
+        p packages: limit the query to these packages, defaults to all
+    """
+    if os_family() == 'debian':
+        cmd = "dpkg-query -W -f '%s'" % DPKG_QUERY_FORMAT
+    else:
+        cmd = "rpm -q --queryformat '%s'" % RPM_QUERY_FORMAT
+        if not packages:
+            cmd = cmd.replace('rpm -q', 'rpm -qa')
+
+    if packages:
+        cmd = "%s %s" % (cmd, ' '.join(packages))
+
+    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                  warn_only=True, capture=True):
+        result = _sudo(cmd)
+
+    # a query for named packages fails for those which aren't installed,
+    # with a line saying so for each of them. anything else, a locked or
+    # corrupt rpmdb say, would make every package look missing.
+    lines = result.splitlines()
+    not_installed = [line for line in lines
+                     if line.endswith(' is not installed') or
+                     'no packages found matching' in line]
+    if result.return_code != 0 and (not packages or not not_installed or
+                                    any(line.startswith('error:')
+                                        for line in lines)):
+        log_red('failed to query the installed packages')
+        print(result)
+        raise SystemExit()
+
+    for line in lines:
+        fields = line.strip().split('\t')
+        if len(fields) < 3:
+            # 'package foo is not installed' and similar messages
+            continue
+        if len(fields) > 3 and not fields[3].endswith(' installed'):
+            # dpkg keeps removed packages around in 'config-files' state
+            continue
+        _index_package(index, fields[0], fields[1], fields[2])
+
+
+def package_inventory():
+    """ returns an index of the packages installed on the current host
+
+        the index is a dict of {name: [{'name': n, 'version': v, 'arch': a}]},
+        built from a single 'rpm -qa' or 'dpkg-query -W' call and cached for
+        the session. name-version and name.arch style keys are indexed too,
+        so that lookups using those forms work as they did with 'rpm -q'.
+    """
+    if env.host_string not in _PACKAGE_INVENTORY:
+        # cached only once the query succeeded
+        index = {}
+        _query_package_inventory(index)
+        _PACKAGE_INVENTORY[env.host_string] = index
+    return _PACKAGE_INVENTORY[env.host_string]
+
+
+def _progress_eta():
+    """ returns an eta callable for wait_for(), estimating the seconds left
+        from the rate at which a (value, percent) poll result progresses
+    """
+    from time import time
+
+    history = []
+
+    def _eta(value):
+        progress = value[1]
+        if progress is None:
+            return None
+        history.append((time(), progress))
+        (t0, p0), (t1, p1) = history[0], history[-1]
+        if p1 <= p0 or t1 <= t0:
+            return None
+        return (100 - p1) / ((p1 - p0) / (t1 - t0))
+
+    return _eta
+
+
 def print_ec2_info():
     """ outputs information about our EC2 instance """
-    _state = load_state_from_disk()
-    if _state:
-        data = get_ec2_info(_state['id'])
-        log_green("Instance state: %s" % data['state'])
-        log_green("Public dns: %s" % data['public_dns_name'])
-        log_green("Ip address: %s" % data['ip_address'])
-        log_green("volume: %s" % data['volume'])
-        log_green("user: %s" % env.user)
-        log_green("ssh -i %s %s@%s" % (env.key_filename,
-                                       env.user,
-                                       data['ip_address']))
+    return _cloud_module('cloud_ec2').status()
 
 
 def print_rackspace_info():
     """ outputs information about our Rackspace instance """
-    _state = load_state_from_disk()
-    if _state:
-        data = get_rackspace_info(_state['id'])
-        log_green("Instance state: %s" % data['status'])
-        log_green("Ip address: %s" % data['ip_address'])
-        log_green("user: %s" % env.user)
-        log_green("ssh -i %s %s@%s" % (env.key_filename,
-                                       env.user,
-                                       data['ip_address']))
+    return _cloud_module('cloud_rackspace').status()
+
+
+def provision(recipe=None, image=True):
+    """ runs a provisioning recipe on the current instance, unless it was
+        booted from a golden image built from the same recipe
+
+        p recipe: defaults to env.provisioning_recipe, see
+                  provisioning_fingerprint()
+        p image: after a full run, create a golden image tagged with the
+                 recipe fingerprint, so the next up() can boot from it
+
+        returns True if the recipe was run, False if it was skipped
+    """
+    data = load_state_from_disk()
+    if not data:
+        log_red("can't find a valid state file")
+        raise SystemExit()
+
+    fingerprint = provisioning_fingerprint(recipe)
+    if data.get('fingerprint') == fingerprint:
+        log_green('booted from golden image %s, nothing to provision' %
+                  fingerprint[:12])
+        return False
+
+    module = sys.modules[__name__]
+    with settings(host_string=env.host_string or data['ip_address']):
+        for step, args, kwargs in _provisioning_steps(recipe):
+            log_yellow('provisioning: %s' % getattr(step, '__name__', step))
+            if not callable(step):
+                step = getattr(module, step)
+            step(*args, **kwargs)
+
+    data['fingerprint'] = fingerprint
+    save_state_locally(data['id'], role=data.get('role'), data=data)
+
+    if str(image).lower() in ['true', 'yes', '1']:
+        create_image(data['id'],
+                     'golden-%s' % fingerprint[:12],
+                     'provisioned from recipe %s' % fingerprint,
+                     fingerprint=fingerprint)
+    return True
+
+
+def provisioning_fingerprint(recipe=None):
+    """ returns a digest identifying everything a provisioning recipe puts
+        on an instance
+
+        p recipe: a list of steps, defaults to env.provisioning_recipe.
+                  a step is the name of a function in this module or a
+                  callable, optionally followed by a list of arguments and
+                  a dict of keyword arguments, ie:
+                  [('yum_install', [], {'packages': ['git', 'gcc']}),
+                   ('cache_docker_images_locally', [['centos:7']]),
+                   'install_docker']
+
+        the fingerprint covers the base image, each step with its arguments
+        (package lists, docker images...), the source code of the functions
+        called, and the source tree manifest when the recipe calls rsync.
+    """
+    import hashlib
+    import inspect
+
+    module = sys.modules[__name__]
+    steps = []
+    uses_rsync = False
+    for step, args, kwargs in _provisioning_steps(recipe):
+        func = step if callable(step) else getattr(module, step)
+        name = '%s.%s' % (func.__module__, func.__name__)
+        try:
+            code = inspect.getsource(func)
+        except (IOError, TypeError):
+            code = None
+        uses_rsync = uses_rsync or func is module.rsync
+        steps.append([name, code, list(args), kwargs])
+
+    source = None
+    if uses_rsync and 'SOURCE_PATH' in os.environ:
+        source_path = os.path.abspath(os.environ['SOURCE_PATH'])
+        excludes = env.get('rsync_excludes',
+                           ['.git', '.tox', '.vagrant', 'venv'])
+        previous = _load_rsync_manifests().get(source_path, {})
+        source = _manifest_digest(
+            _source_manifest(source_path, excludes,
+                             previous.get('files', {})))
+
+    base_image = {'ec2': env.get('ec2_ami'),
+                  'rackspace': env.get('rackspace_image')}.get(env.cloud)
+    recipe = {'cloud': env.cloud,
+              'base_image': base_image,
+              'steps': steps,
+              'source': source}
+    return hashlib.sha1(json.dumps(recipe, sort_keys=True,
+                                   default=str).encode('utf-8')).hexdigest()
+
+
+def _provisioning_steps(recipe=None):
+    """ returns a recipe as a list of (step, args, kwargs) """
+    if recipe is None:
+        recipe = env.get('provisioning_recipe', [])
+
+    steps = []
+    for entry in recipe:
+        if callable(entry) or not isinstance(entry, (list, tuple)):
+            entry = [entry]
+        step = entry[0]
+        args = entry[1] if len(entry) > 1 else []
+        kwargs = entry[2] if len(entry) > 2 else {}
+        steps.append((step, args, kwargs))
+    return steps
+
+
+def _parallel_map(func, items, concurrency=None):
+    """ calls func on every item using a pool of threads, returning the
+        results in the same order as items
+
+        p concurrency: number of threads, defaults to env.parallel_pool_size
+                       or 10. exceptions are re-raised in the caller.
+    """
+    try:
+        from Queue import Queue, Empty
+    except ImportError:
+        from queue import Queue, Empty
+
+    items = list(items)
+    if concurrency is None:
+        concurrency = env.get('parallel_pool_size', 10)
+
+    pending = Queue()
+    for position, item in enumerate(items):
+        pending.put((position, item))
+    results = [None] * len(items)
+    errors = []
+
+    def _worker():
+        while True:
+            try:
+                position, item = pending.get_nowait()
+            except Empty:
+                return
+            try:
+                results[position] = func(item)
+            except Exception as e:
+                errors.append(e)
+
+    workers = [threading.Thread(target=_worker)
+               for _ in range(min(int(concurrency), len(items)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+def _pool_member_settings(name, **kwargs):
+    """ returns settings() acting on the pool member name. data.json keeps
+        tracking the instance it was written for.
+    """
+    return settings(instance_name=name, data_json=False, **kwargs)
+
+
+def pool_members(role=None):
+    """ returns the state of the warm pool members of a role, including
+        those still being provisioned
+    """
+    return [data for data in load_state_store()['instances'].values()
+            if data.get('pool') and data.get('role') == role]
 
 
 def rackspace():
     env.cloud = 'rackspace'
 
 
+def _rackspace_server_data(server):
+    """ returns the state we keep for a rackspace server object """
+    data = {}
+    data['id'] = server.id
+    # this needs to be tackled
+    data['ip_address'] = get_ip_address_from_rackspace_server(server.id,
+                                                              server=server)
+    data['state'] = server.status
+
+    # TODO: volumes are missing
+    return data
+
+
+def _record_trace(kind, function, command, started, host=None,
+                  exit_code=None, output_bytes=0):
+    """ appends an event to the session trace """
+    from time import time
+
+    _TRACE.append({'kind': kind,
+                   'host': host or env.host_string or 'localhost',
+                   'function': function,
+                   'command': command,
+                   'start': started,
+                   'duration': time() - started,
+                   'exit_code': exit_code,
+                   'output_bytes': output_bytes,
+                   'thread': threading.current_thread().ident})
+
+
+def register_cloud_backend(name, backend):
+    """ registers a cloud backend, selected by setting env.cloud to name
+
+        p backend: a dict of {action: function}, or the dotted path of a
+                   module defining the actions as functions, which is only
+                   imported once the backend is used.
+                   actions are listed in CLOUD_ACTIONS.
+    """
+    _CLOUD_BACKENDS[name] = backend
+
+
+def replenish_pool(role=None):
+    """ runs fill_pool() in a detached process, so that the caller can carry
+        on with the instance it was handed and the fab run exits without
+        waiting for the refill. its output goes to env.pool_log, which
+        defaults to pool.log.
+
+        returns the pid of the detached process
+    """
+    # anything still buffered would be printed again by the children
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    read_fd, write_fd = os.pipe()
+    child = os.fork()
+    if child:
+        os.close(write_fd)
+        pid = int(os.read(read_fd, 32) or 0)
+        os.close(read_fd)
+        # the first child exits as soon as the refill is started
+        os.waitpid(child, 0)
+        log_green('replenishing the warm pool in the background (pid %d)' %
+                  pid)
+        return pid
+
+    # the first child leaves the fab run's session, starts the refill and
+    # exits, so that the refill is reparented to init
+    os.close(read_fd)
+    os.setsid()
+    pid = os.fork()
+    if pid:
+        os.write(write_fd, str(pid).encode())
+        os._exit(0)
+    os.close(write_fd)
+
+    status = 1
+    try:
+        log = os.open(env.get('pool_log', 'pool.log'),
+                      os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(log, 1)
+        os.dup2(log, 2)
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+        # cloud connections aren't safe to share with the parent
+        invalidate_cloud_connections()
+        fill_pool(role)
+        status = 0
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
 def reboot():
-    sudo('shutdown -r now')
+    invalidate_host_facts()
+    _sudo('shutdown -r now')
 
 
 def remove_image(image):
-    sudo('docker rmi -f %s' % get_image_id(image))
+    image_id = get_image_id(image)
+    if image_id:
+        _sudo('docker rmi -f %s' % image_id)
+        images = docker_inventory()['images']
+        for ref, entry in list(images.items()):
+            if entry['id'] == image_id:
+                del images[ref]
 
 
 def remove_container(container):
-    sudo('docker rm -f %s' % get_container_id(container))
+    entry = _docker_container(container)
+    if entry:
+        _sudo('docker rm -f %s' % entry['id'])
+        containers = docker_inventory()['containers']
+        containers.pop(entry['id'], None)
+        containers.pop(entry['name'], None)
 
 
-def rsync():
-    """ syncs the src code to the remote box """
-    from fabric.context_managers import lcd
-    log_green('syncing code to remote box...')
-    data = load_state_from_disk()
-    if 'SOURCE_PATH' in os.environ:
-        with lcd(os.environ['SOURCE_PATH']):
-            local("rsync  -a "
-                  "--info=progress2 "
-                  "--exclude .git "
-                  "--exclude .tox "
-                  "--exclude .vagrant "
-                  "--exclude venv "
-                  ". "
-                  "-e 'ssh -C -i " + env.ec2_key_filename + "' "
-                  "%s@%s:" % (env.user, data['ip_address']))
-    else:
+def rpm_packages_missing(packages):
+    """ returns the subset of packages which are not installed """
+    index = package_inventory()
+    return [pkg for pkg in packages if pkg not in index]
+
+
+def _rsync_manifest_file():
+    """ returns the path of the file the rsync manifests are saved to """
+    return env.get('rsync_manifest_file', '.rsync-manifest.json')
+
+
+def retire_stale_pool_members(role=None):
+    """ destroys the pool members of a role which are of no more use: ready
+        members which weren't built from the current
+        env.provisioning_recipe, and members stuck warming up or retiring
+        for longer than env.pool_warming_timeout seconds (3600 by
+        default), e.g. after their fill_pool() was killed
+
+        returns the names of the retired members
+    """
+    from time import time
+
+    fingerprint = None
+    if env.get('provisioning_recipe'):
+        fingerprint = provisioning_fingerprint()
+    stuck_since = time() - float(env.get('pool_warming_timeout', 3600))
+
+    def _is_stale(data):
+        if data.get('role') != role:
+            return False
+        if data.get('pool') == 'ready':
+            return (fingerprint is not None and
+                    data.get('fingerprint') != fingerprint)
+        return (data.get('pool') in ['warming', 'retiring'] and
+                data.get('pool_since', 0) < stuck_since)
+
+    # taken out of the pool first, so that nobody claims them meanwhile.
+    # reservations which never got an instance are simply dropped
+    def _retire(store):
+        stale = []
+        for name, data in list(store['instances'].items()):
+            if not _is_stale(data):
+                continue
+            if data.get('id') is None:
+                del store['instances'][name]
+                continue
+            data['pool'] = 'retiring'
+            data['pool_since'] = time()
+            stale.append(name)
+        return sorted(stale)
+
+    stale = update_state_store(_retire)
+    for name in stale:
+        log_yellow('retiring stale pool member %s' % name)
+        _discard_pool_member(name)
+    return stale
+
+
+def reset_trace():
+    """ drops the events recorded so far """
+    del _TRACE[:]
+
+
+def rsync(*hosts, **kwargs):
+    """ syncs the src code to the remote boxes
+
+        p hosts: hosts to sync to, defaults to the current instance
+        p role: sync to every instance with this role in the state store
+        p force: sync even if the source tree hasn't changed since the last
+                 push to a host
+
+        the source tree is scanned once into a manifest of (size, mtime,
+        sha1) per file, and hosts which already received the same tree are
+        skipped. the remaining hosts are synced concurrently, see
+        env.parallel_pool_size. files matching env.rsync_excludes are left
+        out.
+    """
+    if 'SOURCE_PATH' not in os.environ:
         print('please export SOURCE_PATH before running rsync')
         exit(1)
 
+    source_path = os.path.abspath(os.environ['SOURCE_PATH'])
+    excludes = env.get('rsync_excludes', ['.git', '.tox', '.vagrant', 'venv'])
+    force = str(kwargs.get('force', False)).lower() in ['true', 'yes', '1']
+
+    hosts = list(hosts)
+    if 'role' in kwargs:
+        hosts += [data['ip_address']
+                  for data in find_instances(role=kwargs['role'])]
+    if not hosts:
+        hosts = [load_state_from_disk()['ip_address']]
+
+    manifests = _load_rsync_manifests()
+    previous = manifests.get(source_path, {})
+    files = _source_manifest(source_path, excludes, previous.get('files', {}))
+    digest = _manifest_digest(files)
+    pushed = previous.get('pushed', {})
+
+    targets = [host for host in hosts
+               if force or pushed.get(host) != digest]
+    for host in set(hosts) - set(targets):
+        log_green('%s is already up to date' % host)
+    if not targets:
+        return
+
+    log_green('syncing code to %s...' % ' '.join(targets))
+    progress = '--info=progress2 ' if len(targets) == 1 else ''
+    exclude = ' '.join("--exclude '%s'" % e for e in excludes)
+
+    def _push(host):
+        result = _local("rsync -a %s%s %s/ "
+                       "-e '%s' "
+                       "%s@%s:" % (progress, exclude, source_path,
+                                   ssh_command(host), env.user, host),
+                       capture=len(targets) > 1)
+        return result.return_code == 0
+
+    with settings(warn_only=True):
+        results = _parallel_map(_push, targets)
+
+    # re-read the manifests, another fab process may have pushed meanwhile
+    manifests = _load_rsync_manifests()
+    entry = manifests.setdefault(source_path, {'pushed': {}})
+    entry['files'] = files
+    for host, ok in zip(targets, results):
+        if ok:
+            entry['pushed'][host] = digest
+        else:
+            entry['pushed'].pop(host, None)
+            log_red('rsync to %s failed' % host)
+    _write_json_atomically(_rsync_manifest_file(), manifests)
+
+
+def _run(command, *args, **kwargs):
+    """ runs fabric's run(), recording it in the trace """
+    if getattr(_BATCH, 'steps', None) is not None:
+        return _batched_command('run', command, args, kwargs)
+    return _traced_command('run', fabric.api.run, command, args, kwargs)
+
+
+def _run_batch(steps):
+    """ compiles the steps recorded by batch() into a single script, runs it
+        and hands each step its own output and exit status
+    """
+    import base64
+    import uuid
+
+    if not steps:
+        return
+
+    use_sudo = any(step.kind == 'sudo' for step in steps)
+    marker = '@@batch-%s' % uuid.uuid4().hex
+    lines = ['__rc=0']
+    for n, step in enumerate(steps):
+        command = step.command
+        if use_sudo and step.kind == 'run':
+            # _run() steps keep running as the login user
+            command = 'sudo -H -u %s bash -c %s' % (env.user,
+                                                    _shell_quote(command))
+        elif step.user:
+            command = 'sudo -H -u %s bash -c %s' % (step.user,
+                                                    _shell_quote(command))
+        lines.append("echo '%s %d start'" % (marker, n))
+        # a subshell per step, so that an 'exit' or 'cd' in one step doesn't
+        # leak into the next, as with separate sudo calls
+        lines.append('( %s\n) 2>&1; __rc=$?' % command)
+        lines.append("echo '%s %d end '$__rc" % (marker, n))
+        if not step.warn_only:
+            lines.append('[ $__rc -eq 0 ] || exit 0')
+    script = '\n'.join(lines) + '\n'
+
+    runner = _sudo if use_sudo else _run
+    encoded = base64.b64encode(script.encode('utf-8')).decode('ascii')
+    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                  warn_only=True, capture=True):
+        result = runner('echo %s | base64 -d | bash' % encoded)
+
+    current = None
+    output = []
+    for line in result.splitlines():
+        line = line.rstrip('\r')
+        if line.startswith(marker):
+            fields = line.split()
+            if fields[2] == 'start':
+                current = steps[int(fields[1])]
+                output = []
+            elif current is not None:
+                current.stdout = '\n'.join(output)
+                current.return_code = int(fields[3])
+                current = None
+        elif current is not None:
+            output.append(line)
+    if current is not None:
+        # the script died half way through a step
+        current.stdout = '\n'.join(output)
+        current.return_code = result.return_code or 255
+
+    for step in steps:
+        if step.return_code not in [0, None] and not step.warn_only:
+            log_red('batched command failed: %s' % step.command)
+            log_red(step.stdout)
+            raise SystemExit()
 
-def save_state_locally(instance_id):
+
+def save_state_locally(instance_id, name=None, role=None, data=None):
     """ queries EC2 for details about a particular instance_id and
         stores those details locally
+
+        p name: the instance name, defaults to env.instance_name
+        p role: the role of the instance, defaults to the role already
+                recorded for it, then to env.instance_role
+        p data: details already fetched with get_ec2_info() or
+                get_rackspace_info(), saves querying for them again
+
+        the details are merged into the entry of the instance already
+        recorded under name, if it is the same instance
     """
     if env.cloud == 'ec2':
-        data = get_ec2_info(instance_id)
+        data = data or get_ec2_info(instance_id)
         data['cloud_type'] = 'ec2'
     if env.cloud == 'rackspace':
-        data = get_rackspace_info(instance_id)
+        data = data or get_rackspace_info(instance_id)
         data['cloud_type'] = 'rackspace'
 
-    with open('data.json', 'w') as f:
-        json.dump(data, f)
+    name = name or current_instance_name()
+
+    def _save(store):
+        # fresh details of the instance already recorded under name are
+        # merged into its entry, keeping what only the state store knows
+        # about it: its role, tags, pool and provisioning fingerprint
+        previous = store['instances'].get(name, {})
+        if previous.get('id') != data['id']:
+            previous = {}
+        entry = dict(previous)
+        entry.update(data)
+        entry['name'] = name
+        entry['role'] = (role or previous.get('role') or
+                         env.get('instance_role', None))
+        store['instances'][name] = entry
+        return entry
+
+    data = update_state_store(_save)
+
+    # keep data.json around for the tools that still read it, pool members
+    # are acted on with env.data_json off so they never replace it
+    if name == current_instance_name() and env.get('data_json', True):
+        _write_json_atomically('data.json', data)
+
+
+def _save_fleet_state(members, cloud_type, role, fingerprint=None):
+    """ records the state of a new fleet in the state store in one update.
+        members are named <instance_name>-<n> after the first indexes no
+        other instance uses, so that a second fleet doesn't replace the
+        first.
+
+        p members: the state of every instance in the fleet
+        p fingerprint: the provisioning fingerprint of the golden image the
+                       fleet booted from, if any
+
+        returns the fleet as a dict of {name: state}
+    """
+    prefix = current_instance_name()
+
+    def _save(store):
+        def _free(name):
+            # the reservations made by fill_pool() are there to be taken
+            return store['instances'].get(name, {}).get('id') is None
+
+        fleet = {}
+        n = 0
+        for data in members:
+            while not _free('%s-%d' % (prefix, n)):
+                n += 1
+            name = '%s-%d' % (prefix, n)
+            n += 1
+            data['name'] = name
+            data['cloud_type'] = cloud_type
+            data['role'] = role
+            if fingerprint:
+                data['fingerprint'] = fingerprint
+            # an instance reserved by fill_pool() stays in the pool
+            for key in ['pool', 'pool_since']:
+                if key in store['instances'].get(name, {}):
+                    data[key] = store['instances'][name][key]
+            store['instances'][name] = data
+            fleet[name] = data
+        return fleet
+
+    return update_state_store(_save)
 
 
 def sleep_for_one_minute():
@@ -735,102 +2672,471 @@ def sleep_for_one_minute():
     sleep(60)
 
 
+def _sibling_module(name):
+    """ returns the dotted path of a module shipped next to this one, which
+        works both when api is imported on its own and as part of a package
+    """
+    package = __name__.rpartition('.')[0]
+    return '%s.%s' % (package, name) if package else name
+
+
+def _source_manifest(source_path, excludes, previous):
+    """ returns {relative path: [size, mtime, sha1]} for a source tree
+
+        files whose size and mtime match the previous manifest keep their
+        previous hash instead of being read again.
+    """
+    import fnmatch
+    import hashlib
+
+    def _excluded(name):
+        return any(fnmatch.fnmatch(name, e) for e in excludes)
+
+    files = {}
+    for root, dirs, names in os.walk(source_path):
+        dirs[:] = [d for d in dirs if not _excluded(d)]
+        for name in names:
+            if _excluded(name):
+                continue
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, source_path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # dangling symlink or file removed during the walk
+            known = previous.get(relative)
+            if known and known[0] == st.st_size and known[1] == st.st_mtime:
+                files[relative] = known
+                continue
+            sha1 = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha1.update(chunk)
+            files[relative] = [st.st_size, st.st_mtime, sha1.hexdigest()]
+    return files
+
+
+def ssh_command(host):
+    """ returns an ssh command line for host which shares a persistent,
+        multiplexed master connection with every other ssh, rsync or
+        ssh_session call made to that host
+
+        the master stays up for env.ssh_control_persist seconds (default
+        600) after its last use, and is closed by close_ssh_masters().
+        control sockets live in env.ssh_control_dir (default
+        ~/.ssh/fabric-collections).
+    """
+    control_dir = os.path.expanduser(
+        env.get('ssh_control_dir', '~/.ssh/fabric-collections'))
+    if not os.path.isdir(control_dir):
+        try:
+            os.makedirs(control_dir, 0o700)
+        except OSError:
+            pass  # created by another thread meanwhile
+    _SSH_MASTERS.add(host)
+
+    # %C is a hash of the connection details, it keeps the socket path
+    # below the unix socket length limit
+    return ('ssh -C -i %s '
+            '-o ControlMaster=auto '
+            '-o ControlPath=%s '
+            '-o ControlPersist=%s' % (env.ec2_key_filename,
+                                      os.path.join(control_dir, '%C'),
+                                      env.get('ssh_control_persist', 600)))
+
+
+def _stream_docker_images(source, target, images, skip_layers):
+    """ pipes docker save on source into docker load on target, leaving
+        out the layers listed in skip_layers (as diff ids)
+
+        layers are named after their diff id in the oci layout of recent
+        docker versions, older versions name them <id>/layer.tar, those
+        are spooled to a temporary file and hashed to find their diff id.
+        returns True if docker load succeeded
+    """
+    import hashlib
+    import subprocess
+    import tarfile
+    import tempfile
+    from time import time
+
+    started = time()
+    output = tempfile.TemporaryFile()
+    save = subprocess.Popen(
+        _docker_shell_argv(source, 'docker save %s' % ' '.join(images)),
+        stdout=subprocess.PIPE)
+    load = subprocess.Popen(_docker_shell_argv(target, 'docker load -q'),
+                            stdin=subprocess.PIPE, stdout=output,
+                            stderr=subprocess.STDOUT)
+    sent = 0
+    try:
+        saved = tarfile.open(fileobj=save.stdout, mode='r|')
+        loaded = tarfile.open(fileobj=load.stdin, mode='w|')
+        for member in saved:
+            data = None
+            if member.isfile():
+                data = saved.extractfile(member)
+                name = member.name
+                if name.startswith('blobs/sha256/') and \
+                        'sha256:' + name.split('/')[-1] in skip_layers:
+                    continue
+                if name.endswith('/layer.tar') and skip_layers:
+                    spool = tempfile.TemporaryFile()
+                    digest = hashlib.sha256()
+                    for chunk in iter(lambda: data.read(1024 * 1024), b''):
+                        digest.update(chunk)
+                        spool.write(chunk)
+                    if 'sha256:' + digest.hexdigest() in skip_layers:
+                        spool.close()
+                        continue
+                    spool.seek(0)
+                    data = spool
+                sent += member.size
+            loaded.addfile(member, data)
+        loaded.close()
+    except (tarfile.TarError, IOError, OSError) as e:
+        log_red('streaming %s to %s failed: %s' % (' '.join(images),
+                                                   target, e))
+        save.kill()
+    finally:
+        try:
+            load.stdin.close()
+        except (IOError, OSError):
+            pass  # docker load already gave up
+        save.wait()
+        load.wait()
+
+    _record_trace('local', 'distribute_docker_images',
+                  'docker save %s | docker load' % ' '.join(images),
+                  started, host=target, exit_code=load.returncode,
+                  output_bytes=sent)
+    if load.returncode != 0:
+        output.seek(0)
+        log_red('docker load on %s failed: %s' % (
+            target, output.read().decode('utf-8', 'replace')))
+    output.close()
+    return load.returncode == 0
+
+
 def ssh_session(*cli):
     from itertools import chain
     """ opens a ssh shell to the host """
     data = load_state_from_disk()
-    local('ssh -t -i %s %s@%s %s' % (env['ec2_key_filename'],
-                                     env['user'], data['ip_address'],
-                                     "".join(chain.from_iterable(cli))))
+    _local('%s -t %s@%s %s' % (ssh_command(data['ip_address']),
+                              env['user'], data['ip_address'],
+                              "".join(chain.from_iterable(cli))))
+
+
+def _read_state_store():
+    """ returns the state store, re-reading it only if the file changed """
+    path = _state_file()
+    try:
+        st = os.stat(path)
+    except OSError:
+        return {'instances': {}}
+
+    # files are replaced atomically, so a new inode means new content even
+    # when the mtime didn't move
+    signature = (st.st_ino, st.st_mtime, st.st_size)
+    if (_STATE_CACHE.get('path') != path or
+            _STATE_CACHE.get('signature') != signature):
+        with open(path, 'r') as f:
+            store = json.load(f)
+        _STATE_CACHE.update({'path': path,
+                             'signature': signature,
+                             'store': store,
+                             'index': None})
+    return _STATE_CACHE['store']
+
+
+def _state_file():
+    """ returns the path of the local state store """
+    return env.get('state_file', 'state.json')
+
+
+def _state_index():
+    """ returns lookup tables for the instances in the state store,
+        rebuilt whenever the store is re-read
+    """
+    store = load_state_store()
+    if _STATE_CACHE.get('index') is None:
+        index = {'id': {}, 'ip_address': {}, 'role': {},
+                 'cloud_type': {}, 'tag': {}}
+        for name, data in store['instances'].items():
+            for field in ['id', 'ip_address', 'role', 'cloud_type']:
+                if data.get(field):
+                    index[field].setdefault(data[field], set()).add(name)
+            for tag in (data.get('tags') or {}).items():
+                index['tag'].setdefault(tag, set()).add(name)
+        _STATE_CACHE['index'] = index
+    return _STATE_CACHE['index']
 
 
 def status():
     if is_there_state():
-        if env.cloud == 'ec2':
-            print_ec2_info()
-        if env.cloud == 'rackspace':
-            print_rackspace_info()
+        _cloud_action('status')()
+
+
+def _shell_quote(text):
+    """ quotes text as a single shell word """
+    return "'%s'" % text.replace("'", "'\\''")
+
+
+def _sudo(command, *args, **kwargs):
+    """ runs fabric's sudo(), recording it in the trace """
+    if getattr(_BATCH, 'steps', None) is not None:
+        return _batched_command('sudo', command, args, kwargs)
+    return _traced_command('sudo', fabric.api.sudo, command, args, kwargs)
 
 
 def systemd(service, start=True, enabled=True, unmask=False):
-    """ manipulates systemd services """
+    """ manipulates systemd services
+
+        p service: a unit name, or a list of unit names
+        p start: the unit should be running (True) or stopped (False)
+        p enabled: the unit should be enabled (True) or disabled (False)
+        p unmask: unmask the unit if it is masked
+
+        the current state of all units is fetched with a single
+        'systemctl show' and only the actions needed to reach the desired
+        state are run, together in one remote call. a failing action
+        doesn't stop the others.
+        returns a dict of {unit: [actions which succeeded]}
+    """
     from fabric.api import settings
     from fabric.context_managers import hide
 
+    if isinstance(service, (list, tuple)):
+        services = list(service)
+    else:
+        services = [service]
+
+    states = systemd_state(services)
+    actions = dict((svc, []) for svc in services)
+    for svc in services:
+        state = states[svc]
+        masked = 'masked' in [state.get('LoadState'),
+                              state.get('UnitFileState')]
+        if unmask and masked:
+            actions[svc].append('unmask')
+        if enabled and state.get('UnitFileState') not in ['enabled',
+                                                         'static']:
+            actions[svc].append('enable')
+        if not enabled and state.get('UnitFileState') == 'enabled':
+            actions[svc].append('disable')
+        if start and state.get('ActiveState') not in ['active',
+                                                      'activating']:
+            actions[svc].append('start')
+        if not start and state.get('ActiveState') in ['active',
+                                                      'activating',
+                                                      'reloading']:
+            actions[svc].append('stop')
+
+    # unmask must come before start, or a masked unit fails to start.
+    # every action runs on its own, as a failed enable mustn't keep a unit
+    # from starting, and reports its exit status on a line of its own
+    commands = []
+    for action in ['unmask', 'enable', 'disable', 'start', 'stop']:
+        for svc in services:
+            if action in actions[svc]:
+                commands.append('systemctl %s %s; echo "%s %s %s $?"' % (
+                    action, svc, SYSTEMD_STATUS_MARKER, action, svc))
+    if not commands:
+        return actions
+
     with settings(hide('warnings', 'running', 'stdout', 'stderr'),
                   warn_only=True, capture=True):
+        result = _sudo('; '.join(commands))
+
+    succeeded = set()
+    for line in result.splitlines():
+        fields = line.split()
+        if len(fields) == 4 and fields[0] == SYSTEMD_STATUS_MARKER:
+            if fields[3] == '0':
+                succeeded.add((fields[1], fields[2]))
+            else:
+                log_red('systemctl %s %s failed' % (fields[1], fields[2]))
 
-        if start:
-            sudo('systemctl start %s' % service)
-        else:
-            sudo('systemctl stop %s' % service)
+    # only report the actions which were taken
+    return dict((svc, [action for action in actions[svc]
+                       if (action, svc) in succeeded])
+                for svc in services)
 
-        if enabled:
-            sudo('systemctl enable %s' % service)
-        else:
-            sudo('systemctl disable %s' % service)
 
-        if unmask:
-            sudo('systemctl unmask %s' % service)
+def systemd_state(services):
+    """ returns {unit: {property: value}} for a list of units, using a
+        single 'systemctl show' call
+    """
+    from fabric.api import settings
+    from fabric.context_managers import hide
+
+    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                  warn_only=True, capture=True):
+        result = _sudo('systemctl show '
+                      '-p Id -p LoadState -p ActiveState -p UnitFileState '
+                      '%s' % ' '.join(services))
+
+    # systemctl prints one block of properties per unit, in the order the
+    # units were given, separated by empty lines
+    blocks = [[]]
+    for line in result.splitlines():
+        if line.strip():
+            blocks[-1].append(line.strip())
+        elif blocks[-1]:
+            blocks.append([])
+
+    states = {}
+    for svc, block in zip(services, blocks):
+        states[svc] = dict(line.split('=', 1) for line in block
+                           if '=' in line)
+    for svc in services:
+        states.setdefault(svc, {})
+    return states
 
 
 def terminate():
     destroy()
 
 
+def trace_summary(top=10):
+    """ prints the slowest steps and the time spent per host in the trace
+        recorded in this session
+    """
+    events = list(_TRACE)
+    log_green('%d slowest steps:' % int(top))
+    for e in sorted(events, key=lambda e: e['duration'],
+                    reverse=True)[:int(top)]:
+        log_yellow('%8.2fs %-6s %-20s %-28s %s' % (e['duration'], e['kind'],
+                                                   e['host'], e['function'],
+                                                   e['command'][:60]))
+
+    totals = {}
+    for e in events:
+        total = totals.setdefault(e['host'], {'count': 0, 'duration': 0,
+                                              'output_bytes': 0})
+        total['count'] += 1
+        total['duration'] += e['duration']
+        total['output_bytes'] += e['output_bytes']
+    log_green('time spent per host:')
+    for host, total in sorted(totals.items(),
+                              key=lambda t: t[1]['duration'], reverse=True):
+        log_yellow('%8.2fs %5d calls %10d bytes %s' % (
+            total['duration'], total['count'], total['output_bytes'], host))
+
+
+def _traced_command(kind, func, command, args, kwargs):
+    """ runs a fabric command function, recording it in the trace """
+    from time import time
+
+    started = time()
+    result = None
+    try:
+        result = func(command, *args, **kwargs)
+        return result
+    finally:
+        _record_trace(kind, sys._getframe(2).f_code.co_name, command,
+                      started,
+                      host='localhost' if kind == 'local' else None,
+                      exit_code=getattr(result, 'return_code', None),
+                      output_bytes=len(result or ''))
+
+
 def up():
+    """ boots the current instance. with env.pool_size set, a new instance
+        is taken from the warm pool instead of being created, and the pool
+        is replenished in the background
+    """
     if hasattr(env, 'cloud'):
-        if env.cloud == 'ec2':
-            up_ec2()
-        if env.cloud == 'rackspace':
-            up_rackspace()
+        pooled = env.get('pool_size') and not is_there_state()
+        if pooled:
+            claim_pool_member()
+        _cloud_action('up')()
+        if pooled:
+            replenish_pool()
 
 
 def up_ec2():
     """ boots an existing ec2_instance, or creates a new one if needed """
-    # if we don't have a state file, then its likely we need to create a new
-    # ec2 instance.
-    if is_there_state() is False:
-        create_server_ec2()
-    else:
-        conn = connect_to_ec2()
-        # there is a data.json file, which contains our ec2 instance_id
-        data = load_state_from_disk()
-        # boot the ec2 instance
-        instance = conn.start_instances(instance_ids=[data['id']])[0]
-        while instance.state != "running":
-            log_yellow("Instance state: %s" % instance.state)
-            sleep(10)
-            instance.update()
-        # the ip_address has changed so we need to get the latest data from ec2
-        data = get_ec2_info(data['id'])
-        # and make sure we don't return until the instance is fully up
-        wait_for_ssh(data['ip_address'])
-        # lets update our local state file with the new ip_address
-        save_state_locally(instance.id)
-        env.hosts = data['ip_address']
-        print_ec2_info()
+    return _cloud_module('cloud_ec2').up()
 
 
 def up_rackspace():
     """ boots an existing rackspace instance, or creates a new one if needed """
-    # if we don't have a state file, then its likely we need to create a new
-    # rackspace instance.
-    if is_there_state() is False:
-        create_server_rackspace()
-    else:
-        nova = connect_to_rackspace()
-        # there is a data.json file, which contains our server id
-        data = load_state_from_disk()
-        # boot the rackspace instance
-        # rackspace doesn't provide us with a 'up' method, it expects us
-        # to use reboot to power up the server
-        server = nova.servers.get(data['id'])
-        if server.status != "ACTIVE":
-            server.reboot('hard')
-            wait_for_ssh(data['ip_address'])
-            save_state_locally(server.id)
-            print_rackspace_info()
+    return _cloud_module('cloud_rackspace').up()
+
+
+def update_docker_inventory(images):
+    """ refreshes the docker inventory entries for a list of images, used
+        after pulling images instead of rebuilding the whole inventory
+    """
+    index = docker_inventory()['images']
+    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                  warn_only=True, capture=True):
+        result = _sudo("docker image inspect --format "
+                      "'{{.Id}}\\t{{json .RepoTags}}\\t{{json .RepoDigests}}' "
+                      "%s" % ' '.join(images))
+
+    for line in result.splitlines():
+        fields = line.strip().split('\t')
+        if len(fields) != 3:
+            continue  # images which failed to pull
+        # docker images shows the first 12 characters after 'sha256:'
+        image_id = fields[0].split(':')[-1][:12]
+        digests = json.loads(fields[2]) or []
+        for repo_tag in json.loads(fields[1]) or []:
+            repository, tag = repo_tag.rsplit(':', 1)
+            digest = '<none>'
+            for repo_digest in digests:
+                if repo_digest.startswith(repository + '@'):
+                    digest = repo_digest.split('@', 1)[1]
+            _index_docker_image(index, repository, tag, image_id, digest)
+        for repo_digest in digests:
+            repository, digest = repo_digest.split('@', 1)
+            index.setdefault(_docker_image_key(repo_digest),
+                             {'repository': repository,
+                              'tag': '<none>',
+                              'id': image_id,
+                              'digest': digest})
+
+
+def update_package_inventory(packages):
+    """ refreshes the package inventory entries for a list of packages,
+        used after installing or removing packages instead of rebuilding
+        the whole inventory
+    """
+    index = package_inventory()
+    for pkg in packages:
+        for entry in list(index.get(pkg, [])):
+            for key in _package_index_keys(entry):
+                if entry in index.get(key, []):
+                    index[key].remove(entry)
+                    if not index[key]:
+                        del index[key]
+    _query_package_inventory(index, packages)
+
+
+def update_state_store(update):
+    """ applies update(store) to the state store, holding a lock on it so
+        that parallel fab processes don't overwrite each other's changes
+
+        returns whatever update() returns
+    """
+    import copy
+    import fcntl
+
+    with _STATE_LOCK:
+        with open(_state_file() + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # never modify the cached copy in place, a failing update
+                # would leave it out of sync with the file
+                store = copy.deepcopy(_read_state_store())
+                result = update(store)
+                _write_json_atomically(_state_file(), store)
+                _read_state_store()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    return result
 
 
 def update_system_pip_to_latest_pip():
@@ -840,67 +3146,308 @@ def update_system_pip_to_latest_pip():
 
     with settings(hide('warnings', 'running', 'stdout', 'stderr'),
                   warn_only=False, capture=True):
-        sudo("pip install --quiet --upgrade pip")
+        _sudo("pip install --quiet --upgrade pip")
 
 
 def update_to_latest_pip():
     """ install the latest pip """
-    from fabric.api import settings, run
+    from fabric.api import settings
     from fabric.context_managers import hide
 
     with settings(hide('warnings', 'running', 'stdout', 'stderr'),
                   warn_only=False, capture=True):
-        run("pip install --quiet --upgrade pip")
+        _run("pip install --quiet --upgrade pip")
+
+
+def _update_package_cache_index(cache_dir, key, files):
+    """ records the files cached for a set of packages in the index of a
+        package cache directory, holding a lock on it so that parallel fab
+        processes don't overwrite each other's entries
+    """
+    import fcntl
+    import time
+
+    path = os.path.join(cache_dir, 'index.json')
+    with _PACKAGE_CACHE_LOCK:
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = _package_cache_index(cache_dir)
+                index[key] = {'files': files, 'time': time.time()}
+                _write_json_atomically(path, index)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _write_json_atomically(path, data):
+    """ writes data to path as json, replacing the file in a single rename so
+        that readers never see a partial file
+    """
+    tmp = '%s.%d.%d.tmp' % (path, os.getpid(),
+                            threading.current_thread().ident)
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
 
 
 def yum_install(**kwargs):
     """
-        installs a yum package
+        installs a list of yum packages in a single yum transaction
+
+        p packages: list of packages to install
+        p repo: optional repository to enable for this transaction
+        p warn_only: report packages which failed to install instead of
+                     aborting the run
+
+        with env.package_cache_dir set, the packages are downloaded once per
+        distribution and pushed to the other hosts from the local package
+        cache.
+
+        returns a dict of {package: True|False} with the installed state of
+        each package after the transaction
     """
-    if 'repo' in kwargs:
-        repo = kwargs['repo']
+    packages = list(kwargs['packages'])
+    repo = kwargs.get('repo', None)
+    warn_only = kwargs.get('warn_only', False)
+
+    missing = rpm_packages_missing(packages)
+    if missing:
+        if repo:
+            log_green("installing %s from repo %s ..." % (
+                ' '.join(missing), repo))
+            options = "--enablerepo=%s " % repo
+        else:
+            log_green("installing %s ..." % ' '.join(missing))
+            options = ""
+        cmd = "yum install -y --quiet %s%s" % (options, ' '.join(missing))
+
+        result = None
+        if _package_cache_dir():
+            result = _cached_package_install(
+                'yum install %s%s' % (options, ' '.join(sorted(missing))),
+                download=cmd + " --downloadonly --downloaddir={dir}",
+                install="yum install -y --quiet %s{files}" % options)
+        if result is None:
+            with settings(warn_only=True):
+                _sudo(cmd)
+        # yum returns 0 even when only part of the transaction succeeded,
+        # so we check the outcome of every package we asked for.
+        update_package_inventory(missing)
+        missing = rpm_packages_missing(missing)
+        for pkg in missing:
+            log_red("failed to install %s" % pkg)
+        if missing and not warn_only:
+            raise SystemExit()
 
-    for pkg in list(kwargs['packages']):
-        if is_package_installed(pkg) is False:
-            if 'repo' in locals():
-                log_green("installing %s from repo %s ..." % (pkg, repo))
-                sudo("yum install -y --quiet --enablerepo=%s %s" % (repo, pkg))
-            else:
-                log_green("installing %s ..." % pkg)
-                sudo("yum install -y --quiet %s" % pkg)
+    return dict((pkg, pkg not in missing) for pkg in packages)
 
 
-def yum_install_from_url(pkg_name, url):
+def yum_install_from_url(pkg_name, url, warn_only=False):
     """ installs a pkg from a url
         p pkg_name: the name of the package to install
         p url: the full URL for the rpm package
+        p warn_only: return False instead of aborting the run on failure
     """
+    return yum_install_from_urls({pkg_name: url},
+                                 warn_only=warn_only)[pkg_name]
 
-    from fabric.api import settings
-    from fabric.context_managers import hide
 
-    if is_package_installed(pkg_name) is False:
-        log_green("installing %s from %s" % (pkg_name, url))
+def yum_install_from_urls(packages, warn_only=False):
+    """ installs a list of pkgs from urls in a single yum transaction
+        p packages: a dict of {pkg_name: url}
+        p warn_only: report packages which failed to install instead of
+                     aborting the run
+
+        with env.package_cache_dir set, each url is downloaded once and
+        pushed to the other hosts from the local package cache.
+
+        returns a dict of {pkg_name: True|False} with the installed state of
+        each package after the transaction
+    """
+    missing = rpm_packages_missing(list(packages))
+    if missing:
+        urls = [packages[pkg] for pkg in missing]
+        log_green("installing %s from %s" % (' '.join(missing),
+                                              ' '.join(urls)))
+        result = None
+        if _package_cache_dir():
+            result = _cached_package_install(
+                'yum install %s' % ' '.join(sorted(urls)),
+                download="cd {dir} && curl -fsSL --remote-name-all %s" %
+                         ' '.join(urls),
+                install="yum install -y --quiet {files}")
         with settings(hide('warnings', 'running', 'stdout', 'stderr'),
                       warn_only=True, capture=True):
-
-            result = sudo("rpm -i %s" % url)
-            if result.return_code == 0:
-                return True
-            elif result.return_code == 1:
-                return False
-            else:  # print error to user
+            if result is None:
+                result = _sudo("yum install -y --quiet %s" % ' '.join(urls))
+            if result.return_code not in [0, 1]:
                 print(result)
                 raise SystemExit()
+        update_package_inventory(missing)
+        missing = rpm_packages_missing(missing)
+        for pkg in missing:
+            log_red("failed to install %s" % pkg)
+        if missing and not warn_only:
+            raise SystemExit()
+
+    return dict((pkg, pkg not in missing) for pkg in packages)
+
+
+def wait_for(poll, done, failed=None, msg='waiting...',
+             initial_interval=None, max_interval=None, timeout=None,
+             backoff=2, jitter=0.2, eta=None, abort=True):
+    """ polls until a condition is met, backing off exponentially
+
+        p poll: callable returning the current value (ie: a state)
+        p done: callable, returns True when the value is terminal
+        p failed: optional callable, returns True when the value is a failure
+        p msg: message logged while waiting
+        p initial_interval: seconds to sleep after the first poll,
+                            defaults to env.wait_initial_interval or 2
+        p max_interval: upper bound for the sleep between polls,
+                        defaults to env.wait_max_interval or 30
+        p timeout: overall deadline in seconds,
+                   defaults to env.wait_timeout or 1800
+        p backoff: multiplier applied to the interval after each poll
+        p jitter: random fraction added/removed from each interval, so that
+                  many waiters don't poll the API in lockstep
+        p eta: optional callable, returns the estimated seconds until the
+               value is done (or None if unknown). when known, the next poll
+               is scheduled half way to it, within the interval bounds.
+        p abort: raise SystemExit when the value failed or the deadline was
+                 reached, so that a stuck operation stops the run. pass
+                 False to check the returned value instead.
+
+        returns the last polled value, or with abort=False, whether it was
+        done, failed or the deadline was reached. each call is recorded in
+        wait_timings().
+    """
+    import random
+    from time import time
+
+    if initial_interval is None:
+        initial_interval = env.get('wait_initial_interval', 2)
+    if max_interval is None:
+        max_interval = env.get('wait_max_interval', 30)
+    if timeout is None:
+        timeout = env.get('wait_timeout', 1800)
+
+    started = time()
+    deadline = started + timeout
+    interval = initial_interval
+    polls = 0
+    while True:
+        value = poll()
+        polls += 1
+        if done(value):
+            outcome = 'done'
+            break
+        if failed is not None and failed(value):
+            outcome = 'failed'
+            break
+        remaining = deadline - time()
+        if remaining <= 0:
+            log_red('timed out after %ds: %s' % (timeout, msg))
+            outcome = 'timeout'
+            break
+        log_yellow(msg)
+        estimate = eta(value) if eta is not None else None
+        if estimate is not None:
+            interval = max(initial_interval, min(estimate / 2, max_interval))
+        delay = interval * random.uniform(1 - jitter, 1 + jitter)
+        sleep(min(delay, remaining))
+        interval = min(interval * backoff, max_interval)
+
+    _WAIT_TIMINGS.append({'msg': msg,
+                          'outcome': outcome,
+                          'polls': polls,
+                          'duration': time() - started})
+    _record_trace('wait', sys._getframe(1).f_code.co_name, msg, started,
+                  exit_code=outcome)
+    if abort and outcome != 'done':
+        log_red('%s: %s (last value: %s)' % (outcome, msg, value))
+        raise SystemExit()
+    return value
 
 
 def wait_for_ssh(host, port=22, timeout=600):
     """ probes the ssh port and waits until it is available """
+    from time import time
+
     log_yellow('waiting for ssh...')
-    for iteration in xrange(1, timeout):
+    deadline = time() + timeout
+    while time() < deadline:
         if is_ssh_available(host, port):
             log_green('ssh is now available.')
             return True
         else:
             log_yellow('waiting for ssh...')
         sleep(1)
+    log_red('timed out waiting for ssh on %s' % host)
+    return False
+
+
+def wait_for_ssh_hosts(hosts, port=22, timeout=600, concurrency=None):
+    """ probes many hosts concurrently, yielding (host, available) tuples in
+        the order the hosts become available (or time out)
+
+        p hosts: list of hostnames or ip addresses
+        p timeout: seconds each host is given, counted from when its probe
+                   starts, so hosts queued behind slow ones still get theirs
+        p concurrency: number of hosts probed at the same time,
+                       defaults to env.ssh_probe_concurrency or 100
+    """
+    try:
+        from Queue import Queue
+    except ImportError:
+        from queue import Queue
+    from time import time
+
+    if concurrency is None:
+        concurrency = env.get('ssh_probe_concurrency', 100)
+
+    pending = Queue()
+    results = Queue()
+    for host in hosts:
+        pending.put(host)
+
+    def _probe():
+        while True:
+            try:
+                host = pending.get_nowait()
+            except Exception:
+                return
+            available = False
+            deadline = time() + timeout
+            while time() < deadline:
+                if is_ssh_available(host, port):
+                    available = True
+                    break
+                sleep(1)
+            results.put((host, available))
+
+    for _ in range(min(concurrency, len(hosts))):
+        worker = threading.Thread(target=_probe)
+        worker.daemon = True
+        worker.start()
+
+    for _ in hosts:
+        host, available = results.get()
+        if available:
+            log_green('ssh is now available on %s.' % host)
+        else:
+            log_red('timed out waiting for ssh on %s' % host)
+        yield host, available
+
+
+def wait_timings():
+    """ returns the timings recorded by wait_for() in this session, as a
+        list of dicts with the keys msg, outcome, polls and duration
+    """
+    return list(_WAIT_TIMINGS)
+
+
+register_cloud_backend('ec2', _sibling_module('cloud_ec2'))
+register_cloud_backend('rackspace', _sibling_module('cloud_rackspace'))
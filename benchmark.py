@@ -0,0 +1,622 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+"""
+Benchmarks the api.py provisioning workflows against local stand-ins.
+
+The workflows run unmodified, but fabric's sudo/run/local are answered by a
+fake host with a fake package manager, systemd and docker, and the EC2
+connection is a fake boto connection. Time is simulated: sleeps, command
+round trips and API calls advance a virtual clock instead of blocking, so
+the whole suite runs in seconds while reporting how long each workflow
+would take against a real host and cloud.
+
+For every workflow the number of remote round trips, local commands, cloud
+API calls, waits and the simulated wall time are reported, so results can
+be compared across versions:
+
+    python benchmark.py
+    python benchmark.py --latency 0.1 --api-latency 0.3 --json results.json
+
+Use --host user@host to run the remote command workflows (yum, systemd,
+docker) against a real local box or container instead of the fake host.
+Concurrent phases are charged sequentially on the virtual clock.
+"""
+import json
+import os
+import re
+import shlex
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import fabric.api
+from fabric.api import env
+
+import api
+
+# the virtual clock, see _install_virtual_clock()
+_CLOCK = {'offset': 0.0, 'real_time': time.time, 'real_sleep': time.sleep}
+
+
+def _advance_clock(seconds):
+    """ moves the virtual clock forward """
+    _CLOCK['offset'] += seconds
+
+
+def _install_virtual_clock():
+    """ makes time.time() and sleep() use the virtual clock """
+    time.time = lambda: _CLOCK['real_time']() + _CLOCK['offset']
+    time.sleep = _advance_clock
+    api.sleep = _advance_clock
+
+
+class FakeResult(str):
+    """ mimics the strings returned by fabric's sudo/run/local """
+    return_code = 0
+    failed = False
+    succeeded = True
+
+
+class FakeHost(object):
+    """ a host answering the commands issued by api.py
+
+        p packages: names of the packages installed at start
+        p latency: simulated seconds per round trip
+    """
+
+    def __init__(self, packages, latency):
+        self.latency = latency
+        self.packages = dict((name, '1.0-1') for name in packages)
+        self.units = {}
+        self.images = {}
+        self.containers = {}
+
+    def execute(self, command, *args, **kwargs):
+        _advance_clock(self.latency)
+        output, return_code, last = [], 0, 0
+        for part in re.split(r' && |; ', command):
+            if part.startswith('echo '):
+                # systemd() echoes the exit status of each systemctl call
+                output.append(' '.join(shlex.split(part)[1:])
+                              .replace('$?', str(last)))
+                continue
+            out, last = self._execute(part.strip())
+            output.append(out)
+            return_code = return_code or last
+        result = FakeResult('\n'.join(o for o in output if o))
+        result.return_code = return_code
+        result.failed = return_code != 0
+        result.succeeded = return_code == 0
+        return result
+
+    def _execute(self, command):
+        if '/etc/os-release' in command:
+            return ('id=centos\nid_like=rhel fedora\nversion_id=7\n'
+                    'machine=x86_64\nkernel=3.10.0\ndist=.el7\n'
+                    'init=systemd'), 0
+
+        words = shlex.split(command)
+        if command.startswith('rpm -qa'):
+            return '\n'.join(self._rpm_line(name)
+                             for name in sorted(self.packages)), 0
+        if command.startswith('rpm -q'):
+            names = [w for w in words[1:] if not w.startswith('-')][1:]
+            lines = [self._rpm_line(name) if name in self.packages
+                     else 'package %s is not installed' % name
+                     for name in names]
+            return '\n'.join(lines), sum(1 for name in names
+                                         if name not in self.packages)
+        if command.startswith('yum install'):
+            for word in words[2:]:
+                if not word.startswith('-'):
+                    name = word.rsplit('/', 1)[-1].split('-')[0]
+                    self.packages[name] = '1.0-1'
+                    # every package drags in a systemd unit of its own name
+                    self.units.setdefault(name, 'disabled')
+            return '', 0
+        if command.startswith('systemctl show'):
+            return '\n\n'.join(self._unit_block(w) for w in words[2:]
+                               if not w.startswith('-') and
+                               '=' not in w and
+                               w not in ['Id', 'LoadState', 'ActiveState',
+                                         'UnitFileState']), 0
+        if command.startswith('systemctl '):
+            for unit in words[2:]:
+                self._systemctl(words[1], unit)
+            return '', 0
+        if command.startswith('docker images'):
+            images = '\n'.join('%s\t%s\t%s\t%s' % (
+                ref.rsplit(':', 1)[0], ref.rsplit(':', 1)[1],
+                image_id, '<none>')
+                for ref, image_id in sorted(self.images.items()))
+            containers = '\n'.join('%s\t%s\t%s\tUp' % (cid, name, image)
+                                   for name, (cid, image)
+                                   in sorted(self.containers.items()))
+            return '%s\n---\n%s' % (images, containers), 0
+        if command.startswith('printf') and 'docker pull' in command:
+            for ref in command.split('|')[0].split()[2:]:
+                self._pull(ref)
+            return '', 0
+        if command.startswith('docker image inspect'):
+            lines = []
+            for ref in words[5:]:
+                ref = ref if ':' in ref else ref + ':latest'
+                if ref in self.images:
+                    lines.append('sha256:%s\t["%s"]\t[]' % (self.images[ref],
+                                                            ref))
+            return '\n'.join(lines), 0
+        if command.startswith('docker pull'):
+            self._pull(words[-1])
+            return '', 0
+        if command.startswith('docker rmi'):
+            for ref, image_id in list(self.images.items()):
+                if image_id == words[-1]:
+                    del self.images[ref]
+            return '', 0
+        return '', 0
+
+    def _pull(self, ref):
+        ref = ref if ':' in ref.rsplit('/', 1)[-1] else ref + ':latest'
+        self.images.setdefault(ref, ('%012x' % abs(hash(ref)))[:12])
+
+    def _rpm_line(self, name):
+        return '%s\t%s\tx86_64' % (name, self.packages[name])
+
+    def _systemctl(self, action, unit):
+        state = self.units.setdefault(unit, 'disabled')
+        if action == 'enable':
+            self.units[unit] = state.replace('disabled', 'enabled')
+        elif action == 'disable':
+            self.units[unit] = state.replace('enabled', 'disabled')
+        elif action == 'start':
+            self.units[unit] = state.split('+')[0] + '+active'
+        elif action == 'stop':
+            self.units[unit] = state.split('+')[0]
+        elif action == 'unmask':
+            self.units[unit] = 'disabled'
+
+    def _unit_block(self, unit):
+        state = self.units.get(unit, 'disabled')
+        return ('Id=%s.service\nLoadState=loaded\nActiveState=%s\n'
+                'UnitFileState=%s' % (unit,
+                                      'active' if '+active' in state
+                                      else 'inactive',
+                                      state.split('+')[0]))
+
+
+class FakeInstance(object):
+    """ a boto ec2 instance whose state moves on with the virtual clock """
+
+    def __init__(self, instance_id, state, boot_time):
+        self.id = instance_id
+        self.state = state
+        self.target = None
+        self.ready_at = 0
+        self.public_dns_name = 'localhost'
+        self.ip_address = '127.0.0.1'
+        self.architecture = 'x86_64'
+        self.tags = {}
+        self.boot_time = boot_time
+
+    def move_to(self, transient, target):
+        self.state = transient
+        self.target = target
+        self.ready_at = time.time() + self.boot_time
+
+    def update(self):
+        if self.target and time.time() >= self.ready_at:
+            self.state, self.target = self.target, None
+        return self.state
+
+
+class FakeImage(object):
+    """ a boto ec2 image, backed by one snapshot """
+
+    def __init__(self, conn, image_id, ready_at):
+        self.conn = conn
+        self.id = image_id
+        self.ready_at = ready_at
+        self.created_at = time.time()
+        self.creationDate = '%020.6f' % self.created_at
+        self.tags = {}
+        self.block_device_mapping = {
+            '/dev/sda1': type('BlockDeviceType', (object,),
+                              {'snapshot_id': 'snap-%s' % image_id})()}
+
+    @property
+    def progress(self):
+        total = max(self.ready_at - self.created_at, 1)
+        done = min(time.time() - self.created_at, total)
+        return '%d%%' % (100 * done / total)
+
+    @property
+    def state(self):
+        return 'available' if time.time() >= self.ready_at else 'pending'
+
+    def run(self, min_count, max_count, **kwargs):
+        return self.conn.run_instances(self.id, max_count)
+
+
+class FakeVolume(object):
+    """ a boto ec2 volume """
+
+    def __init__(self, volume_id, instance_id):
+        self.id = volume_id
+        self.attach_data = type('AttachData', (object,),
+                                {'instance_id': instance_id})()
+
+
+class FakeEC2Connection(object):
+    """ the subset of boto's EC2Connection used by api.py
+
+        p latency: simulated seconds per API call
+        p boot_time: simulated seconds for instance state transitions
+        p image_time: simulated seconds to build an image
+    """
+
+    def __init__(self, latency, boot_time, image_time):
+        self.latency = latency
+        self.boot_time = boot_time
+        self.image_time = image_time
+        self.instances = {}
+        self.volumes = {}
+        self.images = {'ami-base': FakeImage(self, 'ami-base', 0)}
+
+    def __getattribute__(self, name):
+        if not name.startswith('_') and name not in ['latency', 'boot_time',
+                                                     'image_time',
+                                                     'instances', 'volumes',
+                                                     'images']:
+            _advance_clock(object.__getattribute__(self, 'latency'))
+        return object.__getattribute__(self, name)
+
+    def create_image(self, instance_id, name, description,
+                     block_device_mapping=None):
+        image_id = 'ami-%d' % len(self.images)
+        self.images[image_id] = FakeImage(self, image_id,
+                                          time.time() + self.image_time)
+        return image_id
+
+    def copy_image(self, source_region, source_image_id, name=None,
+                   description=None):
+        image_id = 'ami-%d' % len(self.images)
+        self.images[image_id] = FakeImage(self, image_id,
+                                          time.time() + self.image_time)
+        return type('CopyImage', (object,), {'image_id': image_id})()
+
+    def create_tags(self, ids, tags):
+        for resource_id in ids:
+            resource = self.instances.get(resource_id) or \
+                self.images[resource_id]
+            resource.tags.update(tags)
+
+    def delete_volume(self, volume_id):
+        self.volumes.pop(volume_id, None)
+
+    def get_all_images(self, image_ids=None, filters=None, **kwargs):
+        if isinstance(image_ids, str):
+            image_ids = [image_ids]
+        filters = filters or {}
+        return [image for image_id, image in self.images.items()
+                if (image_ids is None or image_id in image_ids) and
+                all(image.tags.get(key[4:]) == value
+                    for key, value in filters.items()
+                    if key.startswith('tag:')) and
+                filters.get('state', image.state) == image.state]
+
+    def get_all_volumes(self, filters=None, **kwargs):
+        wanted = (filters or {}).get('attachment.instance-id')
+        if isinstance(wanted, str):
+            wanted = [wanted]
+        return [v for v in self.volumes.values()
+                if wanted is None or v.attach_data.instance_id in wanted]
+
+    def get_all_snapshots(self, snapshot_ids=None, **kwargs):
+        return [type('Snapshot', (object,), {'progress': image.progress})()
+                for image in self.images.values()
+                if 'snap-%s' % image.id in (snapshot_ids or [])]
+
+    def get_image(self, image_id):
+        return self.images[image_id]
+
+    def get_only_instances(self, instance_ids=None, filters=None, **kwargs):
+        if filters and 'instance_id' in filters:
+            instance_ids = [filters['instance_id']]
+        instances = [i for i in self.instances.values()
+                     if instance_ids is None or i.id in instance_ids]
+        for instance in instances:
+            instance.update()
+        return instances
+
+    def run_instances(self, image_id, count):
+        instances = []
+        for _ in range(count):
+            instance = FakeInstance('i-%05d' % len(self.instances),
+                                    'pending', self.boot_time)
+            instance.move_to('pending', 'running')
+            self.instances[instance.id] = instance
+            volume = FakeVolume('vol-%05d' % len(self.volumes), instance.id)
+            self.volumes[volume.id] = volume
+            instances.append(instance)
+        return type('Reservation', (object,), {'instances': instances})()
+
+    def start_instances(self, instance_ids):
+        return self._transition(instance_ids, 'pending', 'running')
+
+    def stop_instances(self, instance_ids):
+        return self._transition(instance_ids, 'stopping', 'stopped')
+
+    def terminate_instances(self, instance_ids):
+        return self._transition(instance_ids, 'shutting-down', 'terminated')
+
+    def _transition(self, instance_ids, transient, target):
+        instances = [self.instances[i] for i in instance_ids]
+        for instance in instances:
+            if instance.update() != target:
+                instance.move_to(transient, target)
+        return instances
+
+
+def _ssh_banner_server():
+    """ starts a local server answering with an ssh banner, returns its port
+    """
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(50)
+
+    def _serve():
+        while True:
+            client, _ = server.accept()
+            client.sendall(b'SSH-2.0-benchmark\r\n')
+            client.close()
+
+    thread = threading.Thread(target=_serve)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1]
+
+
+def _measure(name, workflow):
+    """ runs a workflow and returns its metrics, taken from api's trace """
+    api.reset_trace()
+    started = time.time()
+    real_started = _CLOCK['real_time']()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        workflow()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    events = api._TRACE
+    return {'workflow': name,
+            'round_trips': sum(1 for e in events
+                               if e['kind'] in ['sudo', 'run']),
+            'local_commands': sum(1 for e in events if e['kind'] == 'local'),
+            'api_calls': sum(1 for e in events if e['kind'] == 'api'),
+            'waits': sum(1 for e in events if e['kind'] == 'wait'),
+            'simulated_seconds': round(time.time() - started, 3),
+            'real_seconds': round(_CLOCK['real_time']() - real_started, 3)}
+
+
+def _is_running(pid):
+    """ checks if a process we didn't start is still running """
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    # a detached process nobody reaps stays around as a zombie
+    try:
+        with open('/proc/%d/stat' % pid) as stat:
+            return stat.read().rsplit(')', 1)[-1].split()[0] != 'Z'
+    except IOError:
+        return True
+
+
+def _wait_for_refills(pids, size, timeout=120):
+    """ waits for the pool refills detached by up(), then checks that they
+        logged to env.pool_log and topped the pool up to size
+    """
+    deadline = _CLOCK['real_time']() + timeout
+    for pid in pids:
+        while _is_running(pid):
+            if _CLOCK['real_time']() > deadline:
+                raise RuntimeError('pool refill %d is still running' % pid)
+            _CLOCK['real_sleep'](0.1)
+
+    log = env.get('pool_log', 'pool.log')
+    if pids and not os.path.isfile(log):
+        raise RuntimeError('the pool refill left no %s' % log)
+    ready = [data for data in api.pool_members()
+             if data['pool'] == 'ready']
+    if pids and len(ready) < size:
+        raise RuntimeError('the pool refill left %d of %d members ready, '
+                           'see %s:\n%s' % (len(ready), size, log,
+                                            open(log).read()))
+
+
+def run_benchmarks(latency=0.05, api_latency=0.2, boot_time=40,
+                   image_time=300, packages=30, host=None):
+    """ runs every workflow and returns a list of metrics dicts
+
+        p latency: simulated seconds per remote round trip
+        p api_latency: simulated seconds per cloud API call
+        p boot_time: simulated seconds for instance state transitions
+        p image_time: simulated seconds to build an AMI
+        p packages: number of packages in the yum_install workflow
+        p host: run remote command workflows against this real host
+    """
+    _install_virtual_clock()
+
+    conn = FakeEC2Connection(api_latency, boot_time, image_time)
+    regions = {}
+
+    def _connect_to_ec2(region=None):
+        # the home region is conn, other regions get their own connection
+        if region in [None, env.ec2_region]:
+            return api._TracedClient(conn, 'ec2')
+        if region not in regions:
+            regions[region] = FakeEC2Connection(api_latency, boot_time,
+                                                image_time)
+        return api._TracedClient(regions[region], 'ec2')
+
+    api.connect_to_ec2 = _connect_to_ec2
+
+    # the refill up() starts is detached from the run and finishes after
+    # it, the fill_pool workflows measure it on their own. it works on its
+    # own copy of the fake cloud, so only the last workflow lets it run,
+    # see _wait_for_refills()
+    refills = []
+    replenish_pool = api.replenish_pool
+
+    def _replenish_pool(role=None):
+        if env.get('benchmark_refill'):
+            refills.append(replenish_pool(role))
+
+    api.replenish_pool = _replenish_pool
+
+    banner_port = _ssh_banner_server()
+    is_ssh_available = api.is_ssh_available
+    api.is_ssh_available = lambda host, port=22, timeout=5: \
+        is_ssh_available('127.0.0.1', banner_port, timeout)
+
+    if host is None:
+        fake = FakeHost(['bash', 'coreutils', 'yum'], latency)
+        fabric.api.sudo = fake.execute
+        fabric.api.run = fake.execute
+        env.host_string = 'benchmark-host'
+    else:
+        env.host_string = host
+
+    env.cloud = 'ec2'
+    env.user = 'benchmark'
+    env.ec2_region = 'local-1'
+    env.ec2_key = env.ec2_secret = 'benchmark'
+    env.ec2_ami = 'ami-base'
+    env.ec2_key_pair = 'benchmark'
+    env.ec2_security = ['default']
+    env.ec2_instancetype = 't2.micro'
+    env.ec2_key_filename = '/dev/null'
+
+    package_list = ['package%02d' % n for n in range(int(packages))]
+    units = ['unit%02d' % n for n in range(5)]
+    images = ['centos:7', 'redis', 'postgres:9.4', 'nginx', 'busybox']
+
+    def _instance_id():
+        return api.load_state_from_disk()['id']
+
+    recipe = [('yum_install', [], {'packages': package_list}),
+              ('systemd', [units], {'unmask': True}),
+              ('cache_docker_images_locally', [images])]
+
+    def _up_and_provision():
+        env.provisioning_recipe = recipe
+        api.up_ec2()
+        api.provision()
+
+    def _fill_pool(state):
+        with fabric.api.settings(pool_state=state):
+            # the stopped members are retired by hand, they are still fresh
+            for data in api.pool_members():
+                with api._pool_member_settings(data['name']):
+                    api.destroy_ec2()
+            api.fill_pool(size=2)
+
+    def _up_from_pool(refill=False):
+        with fabric.api.settings(pool_size=2, benchmark_refill=refill):
+            api.up()
+
+    workflows = [
+        ('up_ec2 (create)', api.up_ec2),
+        ('down_ec2', api.down_ec2),
+        ('up_ec2 (start)', api.up_ec2),
+        ('yum_install %d packages' % len(package_list),
+         lambda: api.yum_install(packages=package_list)),
+        ('yum_install (all present)',
+         lambda: api.yum_install(packages=package_list)),
+        ('systemd %d units' % len(units),
+         lambda: api.systemd(units, unmask=True)),
+        ('systemd (no changes)', lambda: api.systemd(units)),
+        ('docker pull %d images' % len(images),
+         lambda: api.cache_docker_images_locally(images)),
+        ('docker lookups', lambda: [api.does_image_exist(i) and
+                                    api.get_image_id(i) for i in images]),
+        ('create_ami', lambda: api.create_ami(_instance_id(), 'benchmark',
+                                              'benchmark')),
+        ('create_ami + 3 region copies',
+         lambda: api.create_ami(_instance_id(), 'benchmark', 'benchmark',
+                                regions=['copy-1', 'copy-2', 'copy-3'])),
+        ('destroy_ec2', api.destroy_ec2),
+        ('up + provision (no image)', _up_and_provision),
+        ('destroy_ec2', api.destroy_ec2),
+        ('up + provision (golden)', _up_and_provision),
+        ('destroy_ec2', api.destroy_ec2),
+        ('fill_pool 2 stopped', lambda: api.fill_pool(size=2)),
+        ('up (stopped pool)', _up_from_pool),
+        ('destroy_ec2', api.destroy_ec2),
+        ('fill_pool 2 running', lambda: _fill_pool('running')),
+        ('up (running pool)', lambda: _up_from_pool(refill=True)),
+    ]
+
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = [_measure(name, workflow) for name, workflow in workflows]
+        _wait_for_refills(refills, 2)
+        return results
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def print_results(results):
+    """ prints the benchmark results as a table """
+    print('%-28s %11s %6s %9s %6s %11s' % ('workflow', 'round trips',
+                                          'local', 'api calls', 'waits',
+                                          'simulated'))
+    for r in results:
+        print('%-28s %11d %6d %9d %6d %10.1fs' % (r['workflow'],
+                                                 r['round_trips'],
+                                                 r['local_commands'],
+                                                 r['api_calls'],
+                                                 r['waits'],
+                                                 r['simulated_seconds']))
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='simulated seconds per remote round trip')
+    parser.add_argument('--api-latency', type=float, default=0.2,
+                        help='simulated seconds per cloud API call')
+    parser.add_argument('--boot-time', type=float, default=40,
+                        help='simulated seconds to start or stop an instance')
+    parser.add_argument('--image-time', type=float, default=300,
+                        help='simulated seconds to build an AMI')
+    parser.add_argument('--packages', type=int, default=30,
+                        help='number of packages to yum_install')
+    parser.add_argument('--host',
+                        help='run the remote workflows against user@host')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(latency=args.latency,
+                             api_latency=args.api_latency,
+                             boot_time=args.boot_time,
+                             image_time=args.image_time,
+                             packages=args.packages,
+                             host=args.host)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
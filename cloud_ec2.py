@@ -0,0 +1,336 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+""" the ec2 cloud backend, registered with register_cloud_backend() and
+    imported the first time env.cloud = 'ec2' needs one of its actions
+"""
+from fabric.api import env
+
+try:
+    from . import api
+except (ImportError, ValueError):
+    import api
+
+
+def _block_device_map():
+    """ returns the block device mapping used for new ec2 instances """
+    from boto.ec2.blockdevicemapping import BlockDeviceMapping
+    from boto.ec2.blockdevicemapping import EBSBlockDeviceType
+
+    # we need a larger boot device to store our cached images
+    dev_sda1 = EBSBlockDeviceType()
+    dev_sda1.size = 250
+    bdm = BlockDeviceMapping()
+    bdm['/dev/sda1'] = dev_sda1
+    return bdm
+
+
+def copy_ami(ami, regions, name, description, fingerprint=None):
+    """ copies an ami from env.ec2_region to a list of regions
+
+        all copies are started concurrently and polled together, a single
+        wait covers every region.
+        p fingerprint: the provisioning fingerprint to tag the copies with
+        returns a dict of {region: ami id or False}
+    """
+    regions = [region for region in regions if region != env.ec2_region]
+    conns = dict((region, api.connect_to_ec2(region)) for region in regions)
+
+    started = api.gather(*[api.cloud_call('ec2', conns[region].copy_image,
+                                          env.ec2_region, ami,
+                                          name=name, description=description)
+                           for region in regions])
+    copies = dict((region, copy.image_id)
+                  for region, copy in zip(regions, started))
+    if fingerprint:
+        api.gather(*[api.cloud_call('ec2', conns[region].create_tags,
+                                    [copies[region]],
+                                    {'fingerprint': fingerprint})
+                     for region in regions])
+    api.log_yellow('copying %s to %s...' % (ami, ' '.join(regions)))
+
+    def _states():
+        images = api.gather(*[api.cloud_call('ec2', conns[region].get_image,
+                                             copies[region])
+                              for region in regions])
+        return dict((region, image.state)
+                    for region, image in zip(regions, images))
+
+    states = api.wait_for(_states,
+                          done=lambda states: all(
+                              state in ['available', 'failed']
+                              for state in states.values()),
+                          msg='copying ami...',
+                          initial_interval=15,
+                          max_interval=120,
+                          timeout=14400,
+                          abort=False)
+
+    result = {}
+    for region in regions:
+        if states[region] == 'available':
+            api.log_green('ami %s available in %s' % (copies[region], region))
+            result[region] = copies[region]
+        else:
+            api.log_red('copy of %s to %s: %s' % (ami, region, states[region]))
+            result[region] = False
+    return result
+
+
+def create_fleet(count, role=None):
+    """
+    Creates count EC2 Instances with a single API request, waits for all of
+    them together and saves their state as <instance_name>-<n>, after the
+    first free indexes. the instances are terminated if anything fails
+    before their state is saved.
+
+    p role: role recorded in the state of every instance, and tagged on it
+    """
+    count = int(count)
+    role = role or env.get('instance_role', None)
+    conn = api.connect_to_ec2()
+
+    api.log_yellow("...Creating %d EC2 instances..." % count)
+    fingerprint, ami = api._golden_image()
+    image = conn.get_all_images(ami or env.ec2_ami)[0]
+    reservation = image.run(count, count,
+                            key_name=env.ec2_key_pair,
+                            security_groups=env.ec2_security,
+                            block_device_map=_block_device_map(),
+                            instance_type=env.ec2_instancetype)
+    ids = [instance.id for instance in reservation.instances]
+
+    # nothing tracks the fleet until its state is saved, terminate it if
+    # anything fails before that
+    try:
+        tags = {"name": 'jenkins-slave-img'}
+        if role:
+            tags['role'] = role
+        conn.create_tags(ids, tags)
+
+        # a single describe call per poll covers the whole fleet
+        instances = api.wait_for(
+            lambda: conn.get_only_instances(instance_ids=ids),
+            done=lambda fleet: all(i.state != u'pending' for i in fleet),
+            msg='waiting for the fleet to leave the pending state...',
+            abort=False)
+        hosts = [i.public_dns_name for i in instances
+                 if i.state == u'running']
+        for host, available in api.wait_for_ssh_hosts(hosts):
+            pass
+
+        volumes = api._ec2_volumes_by_instance(conn, ids)
+        fleet = api._save_fleet_state(
+            [api._ec2_instance_data(instance, volumes.get(instance.id, ''))
+             for instance in instances],
+            'ec2', role, fingerprint)
+    except BaseException:
+        api.log_red("terminating the partially created fleet")
+        conn.terminate_instances(instance_ids=ids)
+        raise
+
+    api.log_green("Created %d EC2 instances" % len(fleet))
+    return fleet
+
+
+def create_image(instance_id, name, description, block_device_mapping=None,
+                 regions=None, fingerprint=None):
+    """ creates an ami from an instance and waits until it is available
+
+        p block_device_mapping: a boto BlockDeviceMapping for the image
+        p regions: optional list of regions to copy the ami to, the copies
+                   are started together and waited on together
+        p fingerprint: the provisioning fingerprint to tag the ami (and its
+                       copies) with, see provisioning_fingerprint()
+
+        returns the ami id, or False if it failed. when regions are given,
+        returns a dict of {region: ami id or False} which includes the
+        source region.
+    """
+    conn = api.connect_to_ec2()
+    ami = conn.create_image(instance_id,
+                            name,
+                            description,
+                            block_device_mapping=block_device_mapping)
+    if fingerprint:
+        conn.create_tags([ami], {'fingerprint': fingerprint})
+
+    # poll often while the snapshots move, and back off when their
+    # progress says the image is still far from ready
+    image_status = api.wait_for(lambda: _image_progress(conn, ami),
+                                done=lambda v: v[0].state == 'available',
+                                failed=lambda v: v[0].state == 'failed',
+                                eta=api._progress_eta(),
+                                msg='creating ami...',
+                                initial_interval=5,
+                                max_interval=60,
+                                timeout=7200,
+                                abort=False)[0]
+
+    if image_status.state == "available":
+        api.log_green("ami %s %s" % (ami, image_status))
+    else:
+        api.log_red("ami %s %s" % (ami, image_status))
+        ami = False
+
+    if not regions:
+        return(ami)
+
+    copies = {env.ec2_region: ami}
+    if ami:
+        copies.update(copy_ami(ami, regions, name, description,
+                               fingerprint=fingerprint))
+    return copies
+
+
+def create_server():
+    """
+    Creates EC2 Instance and saves it state in a local json file
+
+    when env.provisioning_recipe is set and an ami built from the same
+    recipe exists, the instance boots from that ami instead of env.ec2_ami
+    and provision() has nothing left to do.
+    """
+    # looks for existing state for this instance, so that we don't start
+    # additional ec2 instances when we don't need them.
+    #
+    if api.is_there_state():
+        return True
+    else:
+        conn = api.connect_to_ec2()
+
+        api.log_green("Started...")
+        api.log_yellow("...Creating EC2 instance...")
+
+        # get an ec2 ami image object with our choosen ami, or the golden
+        # image already provisioned with our recipe
+        fingerprint, ami = api._golden_image()
+        image = conn.get_all_images(ami or env.ec2_ami)[0]
+        # start a new instance
+        reservation = image.run(1, 1,
+                                key_name=env.ec2_key_pair,
+                                security_groups=env.ec2_security,
+                                block_device_map=_block_device_map(),
+                                instance_type=env.ec2_instancetype)
+
+        # and get our instance_id
+        instance = reservation.instances[0]
+        # add a tag to our instance
+        conn.create_tags([instance.id], {"name": 'jenkins-slave-img'})
+        #  and loop and wait until ssh is available
+        api.wait_for(instance.update,
+                     done=lambda state: state != u'pending',
+                     msg='waiting for instance to leave the pending state...')
+        api.wait_for_ssh(instance.public_dns_name)
+
+        api.log_green("Instance state: %s" % instance.state)
+        api.log_green("Public dns: %s" % instance.public_dns_name)
+        # finally save the details or our new instance into the local state
+        # file
+        data = api.get_ec2_info(instance.id)
+        if fingerprint:
+            data['fingerprint'] = fingerprint
+        api.save_state_locally(instance.id, data=data)
+
+
+def destroy():
+    """ terminates the instance """
+    if api.is_there_state() is False:
+        return True
+    else:
+        conn = api.connect_to_ec2()
+        _state = api.load_state_from_disk()
+        data = api.get_ec2_info(_state['id'])
+        instance = conn.terminate_instances(instance_ids=[data['id']])[0]
+        api.log_yellow('destroying instance ...')
+        api.wait_for(instance.update,
+                     done=lambda state: state == 'terminated',
+                     msg='waiting for instance to terminate...')
+        volume = data['volume']
+        if volume:
+            api.log_yellow('destroying EBS volume ...')
+            conn.delete_volume(volume)
+        api.delete_state()
+
+
+def find_image(fingerprint):
+    """ returns the id of the newest available ami tagged with a
+        provisioning fingerprint, or None
+    """
+    conn = api.connect_to_ec2()
+    images = conn.get_all_images(owners=['self'],
+                                 filters={'tag:fingerprint': fingerprint,
+                                          'state': 'available'})
+    if not images:
+        return None
+    return sorted(images, key=lambda image: image.creationDate)[-1].id
+
+
+def halt():
+    """ shutdown of an existing EC2 instance """
+    conn = api.connect_to_ec2()
+    # checks for a valid state file, containing the details our ec2 instance
+    if api.is_there_state() is False:
+        # we can't shutdown the instance, if we don't know which one it is
+        return False
+    else:
+        # get the instance_id from the state file, and stop the instance
+        data = api.load_state_from_disk()
+        instance = conn.stop_instances(instance_ids=[data['id']])[0]
+        api.wait_for(instance.update,
+                     done=lambda state: state == 'stopped',
+                     msg='waiting for instance to stop...')
+
+
+def _image_progress(conn, ami):
+    """ returns (image, progress) for an ami being created, progress being
+        the average completion percentage of its snapshots, or None
+    """
+    image = conn.get_image(ami)
+    snapshot_ids = [device.snapshot_id
+                    for device in (image.block_device_mapping or {}).values()
+                    if getattr(device, 'snapshot_id', None)]
+    if not snapshot_ids:
+        return image, None
+    snapshots = conn.get_all_snapshots(snapshot_ids=snapshot_ids)
+    progress = [float((snapshot.progress or '0').rstrip('%') or 0)
+                for snapshot in snapshots]
+    return image, sum(progress) / max(len(progress), 1)
+
+
+def status():
+    """ outputs information about our EC2 instance """
+    _state = api.load_state_from_disk()
+    if _state:
+        data = api.get_ec2_info(_state['id'])
+        api.log_green("Instance state: %s" % data['state'])
+        api.log_green("Public dns: %s" % data['public_dns_name'])
+        api.log_green("Ip address: %s" % data['ip_address'])
+        api.log_green("volume: %s" % data['volume'])
+        api.log_green("user: %s" % env.user)
+        api.log_green("ssh -i %s %s@%s" % (env.key_filename,
+                                           env.user,
+                                           data['ip_address']))
+
+
+def up():
+    """ boots an existing ec2_instance, or creates a new one if needed """
+    # if we don't have a state file, then its likely we need to create a new
+    # ec2 instance.
+    if api.is_there_state() is False:
+        create_server()
+    else:
+        conn = api.connect_to_ec2()
+        # there is a state entry, which contains our ec2 instance_id
+        data = api.load_state_from_disk()
+        # boot the ec2 instance
+        instance = conn.start_instances(instance_ids=[data['id']])[0]
+        api.wait_for(instance.update,
+                     done=lambda state: state == 'running',
+                     msg='waiting for instance to start...')
+        # the ip_address has changed so we need to get the latest data from ec2
+        data = api.get_ec2_info(data['id'])
+        # and make sure we don't return until the instance is fully up
+        api.wait_for_ssh(data['ip_address'])
+        # lets update our local state file with the new ip_address
+        api.save_state_locally(instance.id, data=data)
+        env.hosts = data['ip_address']
+        status()
@@ -0,0 +1,269 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+""" the rackspace cloud backend, registered with register_cloud_backend() and
+    imported the first time env.cloud = 'rackspace' needs one of its actions
+"""
+from fabric.api import env
+
+try:
+    from . import api
+except (ImportError, ValueError):
+    import api
+
+
+def create_fleet(count, role=None):
+    """
+    Creates count Rackspace Instances with concurrent API requests, waits
+    for all of them together and saves their state as <instance_name>-<n>,
+    after the first free indexes. servers which fail to build are deleted,
+    and so is the whole fleet if anything fails before its state is saved.
+
+    p role: role recorded in the state of every instance
+    """
+    count = int(count)
+    role = role or env.get('instance_role', None)
+    nova = api.connect_to_rackspace()
+
+    api.log_yellow("Creating %d Rackspace instances..." % count)
+    flavor = nova.flavors.find(name=env.rackspace_flavor)
+    fingerprint, image_id = api._golden_image()
+    if image_id:
+        image = nova.images.get(image_id)
+    else:
+        image = nova.images.find(name=env.rackspace_image)
+
+    created = []
+
+    def _create(n):
+        server = nova.servers.create(
+            name='%s-%d' % (env.rackspace_instance_name, n),
+            flavor=flavor.id,
+            image=image.id,
+            region=env.os_region_name,
+            availability_zone=env.os_region_name,
+            key_name=env.rackspace_key_pair)
+        created.append(server.id)
+        return server
+
+    def _delete(server_id):
+        try:
+            nova.servers.delete(server_id)
+        except Exception as e:
+            api.log_red("failed to delete rackspace instance %s: %s" % (
+                server_id, e))
+
+    # a single list call per poll covers the whole fleet
+    def _fleet():
+        return [server for server in nova.servers.list()
+                if server.id in created]
+
+    # nothing tracks the fleet until its state is saved, delete it if
+    # anything fails before that
+    try:
+        api._parallel_map(_create, range(count))
+        servers = api.wait_for(_fleet,
+                               done=lambda fleet: all(s.status != 'BUILD'
+                                                      for s in fleet),
+                               msg='Waiting for the fleet build to '
+                                   'finish...',
+                               timeout=1800,
+                               abort=False)
+        for server in servers:
+            if server.status != 'ACTIVE':
+                api.log_red("Error creating rackspace instance %s, deleting "
+                            "it" % server.id)
+                _delete(server.id)
+
+        members = [api._rackspace_server_data(server) for server in servers
+                   if server.status == 'ACTIVE']
+        hosts = [data['ip_address'] for data in members
+                 if data['ip_address']]
+        for host, available in api.wait_for_ssh_hosts(hosts):
+            pass
+
+        fleet = api._save_fleet_state(members, 'rackspace', role,
+                                      fingerprint)
+    except BaseException:
+        api.log_red("deleting the partially created fleet")
+        for server_id in created:
+            _delete(server_id)
+        raise
+
+    api.log_green("Created %d Rackspace instances" % len(fleet))
+    return fleet
+
+
+def create_image(server_id,
+                 name,
+                 description,
+                 block_device_mapping=None,
+                 fingerprint=None):
+    """ creates an image from the current rackspace server
+
+        p fingerprint: the provisioning fingerprint to store in the image
+                       metadata, see provisioning_fingerprint()
+    """
+    import sys
+    if not api.is_there_state():
+        api.log_red("can't find a valid state file")
+        sys.exit(1)
+
+    nova = api.connect_to_rackspace()
+    data = api.load_state_from_disk()
+
+    metadata = {'fingerprint': fingerprint} if fingerprint else None
+    image_id = nova.servers.create_image(data['id'], name, metadata=metadata)
+    api.log_green('creating rackspace image...')
+    image = api.wait_for(lambda: nova.images.get(image_id).status.lower(),
+                         done=lambda status: status == 'active',
+                         failed=lambda status: status == 'error',
+                         msg='building rackspace image...',
+                         initial_interval=10,
+                         max_interval=60,
+                         timeout=7200,
+                         abort=False)
+
+    if image != 'active':
+        api.log_red('error creating image')
+        sys.exit(1)
+
+    return image_id
+
+
+def create_server():
+    """
+    Creates Rackspace Instance and saves it state in a local json file
+
+    when env.provisioning_recipe is set and an image built from the same
+    recipe exists, the server boots from that image instead of
+    env.rackspace_image and provision() has nothing left to do.
+    """
+    # looks for existing state for this instance, so that we don't start
+    # additional ec2 instances when we don't need them.
+    #
+    from sys import exit
+
+    if api.is_there_state():
+        return True
+
+    # looks like no state file is available, lets create a new server instance
+    nova = api.connect_to_rackspace()
+    api.log_yellow("Creating Rackspace instance...")
+
+    flavor = nova.flavors.find(name=env.rackspace_flavor)
+    fingerprint, image_id = api._golden_image()
+    if image_id:
+        image = nova.images.get(image_id)
+    else:
+        image = nova.images.find(name=env.rackspace_image)
+
+    # nova.keypairs.create(env.rackspace_key_pair, env.rackspace_public_key)
+
+    server = nova.servers.create(name=env.rackspace_instance_name,
+                                 flavor=flavor.id,
+                                 image=image.id,
+                                 region=env.os_region_name,
+                                 availability_zone=env.os_region_name,
+                                 key_name=env.rackspace_key_pair)
+
+    server = api.wait_for(lambda: nova.servers.get(server.id),
+                          done=lambda s: s.status != 'BUILD',
+                          msg='Waiting for build to finish...',
+                          timeout=1800)
+
+    # check for errors
+    if server.status != 'ACTIVE':
+        api.log_red("Error creating rackspace instance")
+        exit(1)
+
+    # the server was assigned IPv4 and IPv6 addresses, locate the IPv4 address
+    ip_address = server.accessIPv4
+
+    if ip_address is None:
+        api.log_red('No IP address assigned')
+        exit(1)
+
+    api.wait_for_ssh(ip_address)
+    api.log_green('New server with IP address {0}.'.format(ip_address))
+    # finally save the details or our new instance into the local state file
+    data = api.get_rackspace_info(server.id)
+    if fingerprint:
+        data['fingerprint'] = fingerprint
+    api.save_state_locally(server.id, data=data)
+
+
+def destroy():
+    """ terminates the instance """
+    if api.is_there_state() is False:
+        return True
+
+    nova = api.connect_to_rackspace()
+    _state = api.load_state_from_disk()
+    server = nova.servers.get(_state['id'])
+    api.log_yellow('deleting rackspace instance ...')
+    server.delete()
+
+    # wait for server to be deleted, nova raises once it is gone
+    def _server_status():
+        try:
+            return nova.servers.get(server.id).status
+        except Exception:
+            return 'DELETED'
+
+    api.wait_for(_server_status,
+                 done=lambda status: status == 'DELETED',
+                 failed=lambda status: status == 'ERROR',
+                 msg='waiting for deletion ...')
+    api.log_green('The server has been deleted')
+
+
+def find_image(fingerprint):
+    """ returns the id of an active rackspace image whose metadata carries a
+        provisioning fingerprint, or None
+    """
+    nova = api.connect_to_rackspace()
+    for image in nova.images.list():
+        metadata = getattr(image, 'metadata', None) or {}
+        if image.status == 'ACTIVE' and \
+                metadata.get('fingerprint') == fingerprint:
+            return image.id
+    return None
+
+
+def halt():
+    pass
+
+
+def status():
+    """ outputs information about our Rackspace instance """
+    _state = api.load_state_from_disk()
+    if _state:
+        data = api.get_rackspace_info(_state['id'])
+        api.log_green("Instance state: %s" % data['status'])
+        api.log_green("Ip address: %s" % data['ip_address'])
+        api.log_green("user: %s" % env.user)
+        api.log_green("ssh -i %s %s@%s" % (env.key_filename,
+                                           env.user,
+                                           data['ip_address']))
+
+
+def up():
+    """ boots an existing rackspace instance, or creates a new one if
+        needed
+    """
+    # if we don't have a state file, then its likely we need to create a new
+    # rackspace instance.
+    if api.is_there_state() is False:
+        create_server()
+    else:
+        nova = api.connect_to_rackspace()
+        # there is a state entry, which contains our server id
+        data = api.load_state_from_disk()
+        # boot the rackspace instance
+        # rackspace doesn't provide us with a 'up' method, it expects us
+        # to use reboot to power up the server
+        server = nova.servers.get(data['id'])
+        if server.status != "ACTIVE":
+            server.reboot('hard')
+            api.wait_for_ssh(data['ip_address'])
+            api.save_state_locally(server.id)
+            status()